@@ -1,7 +1,43 @@
-from .src import AuthApp
-from .src.fields import BaseField, LoginField, RegisterField, ContactField, IdentityField,\
-    UserViewField, Permission
-from .src.utils import hash_sha256, get_current_user
+from importlib import import_module
+
+# public names are imported on first access, so `python -m fastapi_auth ...`
+# and workers that don't touch AuthApp skip fastapi, jwt and the db drivers
+_lazy = {
+    'AuthApp': '.src.authapp',
+    'BaseField': '.src.fields',
+    'LoginField': '.src.fields',
+    'RegisterField': '.src.fields',
+    'ContactField': '.src.fields',
+    'IdentityField': '.src.fields',
+    'UserViewField': '.src.fields',
+    'Permission': '.src.fields',
+    'hash_sha256': '.src.utils',
+    'get_current_user': '.src.utils',
+    'PasswordHasher': '.src.hashers',
+    'ScryptHasher': '.src.hashers',
+    'PBKDF2Hasher': '.src.hashers',
+    'KeyRing': '.src.keys',
+    'BaseSessionStore': '.src.session_store',
+    'RedisSessionStore': '.src.session_store',
+    'MemorySessionStore': '.src.session_store',
+    'BaseRateLimiter': '.src.rate_limit',
+    'MemoryRateLimiter': '.src.rate_limit',
+    'RedisRateLimiter': '.src.rate_limit',
+}
 # import __main__ as __migrate_script__
 
-LIB_NAME = 'fastapi_auth'
\ No newline at end of file
+LIB_NAME = 'fastapi_auth'
+
+__all__ = ['LIB_NAME', *_lazy]
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(_lazy[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
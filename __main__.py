@@ -1,5 +1,4 @@
 import os
-import runpy
 import sys
 from functools import wraps
 from importlib import import_module, util
@@ -7,55 +6,76 @@ metadata = None
 DB_URL = None
 
 
-def migrate(url, **kwargs):
-    for k, v in kwargs.items():
-        module_name = k
-        obj_name = v
-        break
-    for path in sys.path:
-        if 'fastapi_auth' in path:
-            lib_path = path
-            break
+migration_options = ('directory', 'message', 'revision')
 
-    with open(f'{lib_path}/settings', 'w') as f:
-        f.write(f'{module_name} {obj_name} {os.getcwd()} {url}')
 
+def load_auth(target=None, **kwargs):
+    # target is module:obj, or [module:obj] which arrives as a keyword
+    if target is None:
+        for module_name, obj_name in kwargs.items():
+            if module_name not in migration_options:
+                target = f'{module_name}:{obj_name}'
+                break
+    if target is None or ':' not in target:
+        print('AuthApp required as module:obj')
+        exit()
+    module_name, obj_name = target.split(':')
     sys.path.append(os.getcwd())
-    module = __import__(module_name)
-    perms = getattr(module, obj_name).permissions
-    permissions = []
-    for p in perms:
-        permissions.append({'name': p})
-
-    os.chdir(lib_path)
-    versions = './migrations/versions'
-    os.system('alembic revision --autogenerate')
-    with open(f"{lib_path}/migrations/versions/{os.listdir(path=versions)[0]}", 'r') as f:
-        old_file = f.read()
-    with open(f"{lib_path}/script.by.ponyoverkill", 'r') as f:
-        some_changes = f.read()
-    new_file = old_file.replace('    # ### end Alembic commands ###', some_changes, 1)
-    with open(f"{lib_path}/migrations/versions/{os.listdir(path=versions)[0]}", 'w') as f:
-        f.write(new_file)
-
-    os.system('alembic upgrade head')
-    # os.remove(f'{lib_path}/settings')
-
-
-def delete_migration(url, **kwargs):
-    for path in sys.path:
-        if 'fastapi_auth' in path:
-            lib_path = path
-            break
-    os.chdir(lib_path)
-    os.system('alembic downgrade base')
-    versions = './migrations/versions'
-    os.remove(f"{lib_path}/{versions}/{os.listdir(path=f'{lib_path}{versions}')[0]}")
+    return getattr(import_module(module_name), obj_name)
+
+
+def migrate(url, target=None, directory=None, **kwargs):
+    from .src import migration
+    from .src.exceptions import ArgumentsError
+    auth = load_auth(target, **kwargs)
+    try:
+        missing = migration.migrate(auth, url, directory=directory)
+    except ArgumentsError as e:
+        print(e)
+        exit(1)
+    print(f"Added rights: {', '.join(missing)}" if missing else 'Rights are up to date')
+
+
+def makemigrations(url, target=None, directory=None, message=None, **kwargs):
+    from .src import migration
+    auth = load_auth(target, **kwargs)
+    script = migration.revision(migration.make_config(auth, url, directory), message)
+    print(f'{script.path} written' if script else 'No changes detected')
+
+
+def delete_migration(url, target=None, directory=None, revision='base', **kwargs):
+    from .src import migration
+    auth = load_auth(target, **kwargs)
+    migration.downgrade(migration.make_config(auth, url, directory), revision)
+
+
+def sync_rights(target=None, **kwargs):
+    import asyncio
+    auth = load_auth(target, **kwargs)
+    missing = asyncio.run(auth.sync_rights())
+    print(f"Added rights: {', '.join(missing)}" if missing else 'Rights are up to date')
+
+
+def calibrate_hash(algorithm='scrypt', target_ms=250, **kwargs):
+    from .src.hashers import calibrate_hash as _calibrate_hash, measure_hash
+    hasher = _calibrate_hash(algorithm, float(target_ms))
+    params = ', '.join(f'{k}={v}' for k, v in vars(hasher).items()
+                       if k not in ('salt_size', 'legacy_hash_func') and not k.startswith('_'))
+    print(f'{type(hasher).__name__}({params})  # {measure_hash(hasher):.1f} ms per hash')
+
+
+def codegen(target=None, **kwargs):
+    auth = load_auth(target, **kwargs)
+    print(f'{auth.write_models()} written')
 
 
 commands = {
     'migrate': migrate,
+    'makemigrations': makemigrations,
     'delete_migration': delete_migration,
+    'sync_rights': sync_rights,
+    'calibrate-hash': calibrate_hash,
+    'codegen': codegen,
     'help': None
 }
 
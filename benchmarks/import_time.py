@@ -0,0 +1,33 @@
+# Cold import time of the package entry points, each in a fresh interpreter
+# (what `python -m fastapi_auth ...` and a new worker pay before doing work).
+#
+#   python -m fastapi_auth.benchmarks.import_time [runs]
+#
+# `python -X importtime -c "import fastapi_auth"` shows the per-module split.
+import statistics
+import subprocess
+import sys
+import time
+
+statements = [
+    'pass',
+    'import fastapi_auth',
+    'from fastapi_auth import BaseField, LoginField, RegisterField, Permission',
+    'from fastapi_auth import AuthApp',
+]
+
+
+def measure(statement: str, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for statement in statements:
+        timings = measure(statement, runs)
+        print(f'{statistics.median(timings) * 1000:8.2f}ms  {statement}')
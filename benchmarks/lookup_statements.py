@@ -0,0 +1,61 @@
+# Per-call Python overhead of a user lookup built ad hoc with unbound
+# Column(key) objects (old get_user_by) vs the prebuilt parameterized
+# statement from AuthApp.lookup_statement. Runs on in-memory sqlite so the
+# database round trip is negligible next to statement building/compiling.
+#
+#   python -m fastapi_auth.benchmarks.lookup_statements [calls]
+import sys
+import time
+
+from pydantic import BaseModel
+from sqlalchemy import Column, create_engine, select
+from sqlalchemy.orm import sessionmaker, Session
+
+from ..src import AuthApp
+from ..src.fields import IdentityField, RegisterField, LoginField, Permission
+from ..src.utils import hash_sha256
+
+
+class Roles(BaseModel):
+    client: object = Permission(read=True, write=False)
+
+
+class BenchUser(BaseModel):
+    id: int = IdentityField()
+    password: str = (RegisterField(hash_func=hash_sha256), LoginField(hash_func=hash_sha256))
+    username: str = (RegisterField(), LoginField())
+
+    class Config:
+        database_schema = {'unique': ['username']}
+
+
+def adhoc(auth: AuthApp, db: Session, **kwargs):
+    query = select(auth.user_db).where(*[Column(k) == v for k, v in kwargs.items()])
+    return db.execute(query).scalars().one_or_none()
+
+
+def prebuilt(auth: AuthApp, db: Session, **kwargs):
+    query = auth.lookup_statement(auth.user_db, kwargs)
+    return db.execute(query, kwargs).scalars().one_or_none()
+
+
+def measure(func, auth: AuthApp, db: Session, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        func(auth, db, username=f'user{i % 100}')
+    return (time.perf_counter() - start) / calls
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    engine = create_engine('sqlite://')
+    auth = AuthApp(session_maker=sessionmaker(engine, class_=Session),
+                   user_model=BenchUser, role_model=Roles,
+                   use_jwt_auth=True, jwt_secret_key='bench')
+    auth.user_db.__table__.create(engine)
+    with sessionmaker(engine, class_=Session)() as db:
+        db.execute(auth.user_db.__table__.insert(),
+                   [{'id': i, 'username': f'user{i}', 'password': 'x'} for i in range(100)])
+        for func in (adhoc, prebuilt):
+            measure(func, auth, db, calls // 10)
+            print(f'{func.__name__:>9}: {measure(func, auth, db, calls) * 1e6:8.1f} us/call')
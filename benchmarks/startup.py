@@ -0,0 +1,78 @@
+# Per-worker AuthApp construction time with the models built at runtime and
+# with a module written by `python -m fastapi_auth codegen`. Every run is a
+# fresh interpreter, like a new worker process.
+#
+#   python -m fastapi_auth.benchmarks.startup [runs]
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from pydantic import BaseModel, EmailStr
+
+from ..src.fields import IdentityField, RegisterField, LoginField, ContactField, Permission
+from ..src.utils import hash_sha256
+
+
+class Roles(BaseModel):
+    client: object = Permission(read=True, write=False)
+    admin: object = Permission(read=True, write=True, ban=True)
+
+
+class BenchUser(BaseModel):
+    id: int = IdentityField()
+    password: str = (RegisterField(hash_func=hash_sha256), LoginField(hash_func=hash_sha256))
+    username: str = (RegisterField(required_xor={'email'}), LoginField(required_xor={'email'}))
+    email: EmailStr = (ContactField(), RegisterField(required_xor={'username'}),
+                       LoginField(required_xor={'username'}))
+
+    class Config:
+        database_schema = {'unique': ['username', 'email']}
+
+
+def build():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from ..src import AuthApp
+    # the models must live under their importable name, not __main__
+    from .startup import BenchUser, Roles
+
+    return AuthApp(session_maker=sessionmaker(create_engine('sqlite://')),
+                   user_model=BenchUser, role_model=Roles)
+
+
+def child():
+    start = time.perf_counter()
+    build()
+    print(time.perf_counter() - start)
+
+
+def measure(runs: int) -> list:
+    module = __name__
+    return [
+        float(subprocess.check_output([sys.executable, '-m', module, 'child']))
+        for _ in range(runs)
+    ]
+
+
+def report(name: str, timings: list):
+    print(f'{name:>9}: median={statistics.median(timings) * 1000:8.2f}ms '
+          f'max={max(timings) * 1000:8.2f}ms')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['child']:
+        child()
+        exit()
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    auth = build()
+    path = auth._models_path
+    if os.path.exists(path):
+        os.remove(path)
+    report('runtime', measure(runs))
+    auth.write_models()
+    try:
+        report('generated', measure(runs))
+    finally:
+        os.remove(path)
@@ -1,90 +1,115 @@
-import sys
-from logging.config import fileConfig
+import asyncio
 
-from sqlalchemy import engine_from_config
-from sqlalchemy import pool
+from sqlalchemy import engine_from_config, pool, text, Column
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import async_engine_from_config
 from alembic import context
+from alembic.operations import ops
 
+from fastapi_auth.src.class_builder import login_xid_trigger
+from fastapi_auth.src.migration import LOCK_ID
 
-def get_db_url():
-    with open(f'./settings', 'r') as f:
-        module_name, obj_name, module_path, url = f.read().split()
-    sys.path.append(module_path)
-
-    module = __import__(module_name)
-    metadata = getattr(module, obj_name).metadata
-    return metadata, url
-
-
-# this is the Alembic Config object, which provides
-# access to the values within the .ini file in use.
+# this is the Alembic Config object, built in-process by
+# fastapi_auth.src.migration.make_config with AuthApp.metadata attached
 config = context.config
 
-target_metadata, DB_URL = get_db_url()
-
-section = config.config_ini_section
-config.set_section_option(section, "DB_URL", DB_URL)
-# Interpret the config file for Python logging.
-# This line sets up loggers basically.
-if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
-
-# add your model's MetaData object here
-# for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-
-
-# other values from the config, defined by the needs of env.py,
-# can be acquired:
-# my_important_option = config.get_main_option("my_important_option")
-# ... etc.
+target_metadata = config.attributes['target_metadata']
+
+
+def login_xid_ops(script) -> None:
+    # autogenerate doesn't see DDL events, the trigger keeping user.login_xid
+    # current goes with the revision adding or dropping the column or table
+    upgrade, downgrade = script.upgrade_ops.ops, script.downgrade_ops.ops
+    for op in list(upgrade):
+        if isinstance(op, ops.CreateTableOp):
+            added = any(isinstance(c, Column) and c.name == 'login_xid' for c in op.columns)
+            dropped = False
+        elif isinstance(op, ops.DropTableOp):
+            added, dropped = False, 'login_xid' in op.to_table().c
+        elif isinstance(op, ops.ModifyTableOps):
+            added = any(isinstance(o, ops.AddColumnOp) and o.column.name == 'login_xid'
+                        for o in op.ops)
+            dropped = any(isinstance(o, ops.DropColumnOp) and o.column_name == 'login_xid'
+                          for o in op.ops)
+        else:
+            continue
+        key = f'{op.schema}.{op.table_name}' if op.schema else op.table_name
+        table = target_metadata.tables.get(key)
+        if added and (table is None or not table.info.get('login_xid_trigger')):
+            continue
+        create, drop = login_xid_trigger(op.table_name, op.schema)
+        if added:
+            upgrade += [ops.ExecuteSQLOp(sql) for sql in create]
+            downgrade[:0] = [ops.ExecuteSQLOp(sql) for sql in drop]
+        elif dropped:
+            upgrade[:0] = [ops.ExecuteSQLOp(sql) for sql in drop]
+            downgrade += [ops.ExecuteSQLOp(sql) for sql in create]
+
+
+def process_revision_directives(context, revision, directives) -> None:
+    # an up to date database must not leave empty revisions behind
+    if directives[0].upgrade_ops.is_empty():
+        directives[:] = []
+        return
+    login_xid_ops(directives[0])
 
 
 def run_migrations_offline() -> None:
-    """Run migrations in 'offline' mode.
-
-    This configures the context with just a URL
-    and not an Engine, though an Engine is acceptable
-    here as well.  By skipping the Engine creation
-    we don't even need a DBAPI to be available.
-
-    Calls to context.execute() here emit the given string to the
-    script output.
-
-    """
+    """Run migrations in 'offline' mode, emitting SQL to the script output."""
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
         url=url,
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        process_revision_directives=process_revision_directives,
     )
 
     with context.begin_transaction():
         context.run_migrations()
 
 
-def run_migrations_online() -> None:
-    """Run migrations in 'online' mode.
+def do_run_migrations(connection: Connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        process_revision_directives=process_revision_directives,
+        transaction_per_migration=False,
+    )
 
-    In this scenario we need to create an Engine
-    and associate a connection with the context.
+    with context.begin_transaction():
+        if connection.dialect.name == 'postgresql':
+            # concurrent deploys wait here instead of racing on alembic_version
+            connection.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': LOCK_ID})
+        context.run_migrations()
 
-    """
+
+async def run_async_migrations() -> None:
+    connectable = async_engine_from_config(
+        config.get_section(config.config_ini_section, {}),
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+
+    async with connectable.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+
+    await connectable.dispose()
+
+
+def run_migrations_online() -> None:
+    """Run migrations in 'online' mode, with a sync or async driver."""
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
         poolclass=pool.NullPool,
     )
+    if connectable.dialect.is_async:
+        asyncio.run(run_async_migrations())
+        return
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+        do_run_migrations(connection)
 
 
 if context.is_offline_mode():
@@ -1,6 +1,15 @@
 # from .builder import Builder
-from .authapp import AuthApp
+from importlib import import_module
 # from fastapi_auth.src.exceptions import InvalidModel, DataBaseNotFound
 # from .utils import hash_sha256, xor_fields_maker, hash_validator_maker
 
+# submodules like .fields are imported without loading AuthApp
+_lazy = {'AuthApp': '.authapp'}
 
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(_lazy[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,26 +1,36 @@
+import asyncio
 import datetime
-from functools import wraps
-from typing import Union, AsyncGenerator, Callable, Generator, Any, Annotated
+import math
+import time
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import wraps, partial
+from typing import Union, AsyncGenerator, Callable, Generator, Any, Annotated, Tuple
 from uuid import UUID
 from contextlib import asynccontextmanager
 
 import jwt
 import sqlalchemy
-from fastapi import Depends, APIRouter, Cookie
+from fastapi import APIRouter, Cookie, Body, Request
+from jwt import ExpiredSignatureError, InvalidSignatureError, InvalidTokenError
 from pydantic import BaseModel
-from sqlalchemy import Column, select
+from sqlalchemy import Column, select, bindparam, func, Select, union_all, true, false
 from sqlalchemy.exc import NoResultFound
 # from sqlalchemy.orm.session import se
-from sqlalchemy.ext.asyncio.session import AsyncSession
 from sqlalchemy.orm import Session, sessionmaker
 from starlette.responses import JSONResponse
-import jwt
 
+from .batching import BatchLoader
 from .build_route import build_async
-from .class_builder import ClassBuilder
+from .cache import TTLCache
+from . import codegen
 from .exceptions import DataBaseNotFound, DatabaseError, ArgumentsError
+from .hashers import PasswordHasher
+from .keys import KeyRing
 from .method_builders import SyncMethodBuilder, AsyncMethodBuilder
-from .schemas import User, Roles
+from .rate_limit import BaseRateLimiter
+from .session_store import BaseSessionStore, RedisSessionStore, MemorySessionStore
+from .utils import encode_perms_mask
 
 
 # class GlobalStorage:
@@ -44,12 +54,29 @@ class AuthApp:
             session_maker: sessionmaker = None,
             sql_schema_name: str = None,
             async_usage: bool = None,
-            user_model: BaseModel = User,
-            role_model: BaseModel = Roles,
+            user_model: BaseModel = None,
+            role_model: BaseModel = None,
             use_session_auth: bool = None,
             use_jwt_auth: bool = None,
             jwt_secret_key: str = None,
+            jwt_algorithm: str = 'HS256',
+            jwt_keys: KeyRing = None,
+            perms_bitmask: bool = False,
+            role_tables: bool = False,
+            rights_column: bool = False,
             redis: Any = None,
+            session_store: BaseSessionStore = None,
+            access_lifetime: datetime.timedelta = datetime.timedelta(minutes=15),
+            refresh_lifetime: datetime.timedelta = datetime.timedelta(days=30),
+            access_cache_size: int = 10000,
+            access_cache_ttl: float = 60,
+            hash_executor: Executor = None,
+            db_executor: Executor = None,
+            ip_rate_limiter: BaseRateLimiter = None,
+            login_rate_limiter: BaseRateLimiter = None,
+            login_filter: bool = False,
+            login_filter_fp_rate: float = 0.01,
+            login_filter_max_bytes: int = 64 * 2 ** 20,
             ):
         self.__prefix = prefix
         if use_session_auth is not None and use_jwt_auth is not None\
@@ -81,7 +108,13 @@ class AuthApp:
                 self.async_usage = False
             self.session = self.get_sync_session
             self.__methods_builder = SyncMethodBuilder(self._use_session, self._use_jwt)
-        if issubclass(self.__sessionmaker.class_, AsyncSession):
+        else:
+            # the asyncio extension (and greenlet) is only loaded for async session makers
+            from sqlalchemy.ext.asyncio import AsyncSession
+            if not issubclass(self.__sessionmaker.class_, AsyncSession):
+                raise ArgumentsError(
+                    f'AuthApp session_maker must make Session or AsyncSession,'
+                    f' not {self.__sessionmaker.class_}')
             if async_usage is False:
                 raise ArgumentsError("Can't use AsyncSession with async_usage=False")
             if async_usage is None:
@@ -89,35 +122,162 @@ class AuthApp:
             self.async_usage = async_usage
             self.session = self.get_async_session
             self.__methods_builder = AsyncMethodBuilder(self._use_session, self._use_jwt)
-        elif issubclass(self.__sessionmaker.class_, AsyncSession) and self.async_usage is False:
-            raise ArgumentsError("Can't use AsyncSession with async_usage=False")
 
         self.__sessionmaker = session_maker
 
         self._use_session = use_session_auth
         self._use_jwt = use_jwt_auth
 
-        self.__class_builder = ClassBuilder(user_model=user_model, role_model=role_model)
+        self._async_db = isinstance(self.__methods_builder, AsyncMethodBuilder)
+        if not self._async_db and db_executor is None:
+            # one thread per pooled connection, more threads would only wait for the pool
+            pool = getattr(session_maker.kw.get('bind'), 'pool', None)
+            max_workers = 15
+            if pool is not None and hasattr(pool, 'size'):
+                max_workers = pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+            db_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                             thread_name_prefix='fastapi_auth_db')
+        self._db_executor = db_executor
+
+        # a module written by `python -m fastapi_auth codegen` replaces model parsing
+        # and schema building while its hash still matches the source models
+        if user_model is None or role_model is None:
+            # example models, they pull in pydantic_extra_types/phonenumbers
+            from .schemas import User, Roles
+            user_model = user_model or User
+            role_model = role_model or Roles
+        self._models_hash = codegen.fingerprint(
+            user_model, role_model,
+            sql_schema_name=sql_schema_name,
+            hash_validators=False,
+            sql_sessions=bool(use_session_auth and session_store is None and redis is None),
+            role_tables=role_tables,
+            rights_column=rights_column,
+            login_filter=login_filter,
+        )
+        self._models_path = codegen.module_path(user_model)
+        self.__class_builder = codegen.load(codegen.module_name(user_model), self._models_hash)
+        if self.__class_builder is None:
+            from .class_builder import ClassBuilder
+            self.__class_builder = ClassBuilder(user_model=user_model, role_model=role_model)
+
+        # hash_func runs in hash_executor instead of pydantic validators with both
+        # backends, so a slow kdf never blocks the event loop
+        if hash_executor is None:
+            hash_executor = ThreadPoolExecutor(thread_name_prefix='fastapi_auth_hash')
+        self._hash_executor = hash_executor
+        self._hash_funcs = {
+            schema: validators['hash']
+            for schema, validators in self.__class_builder.validators.items()
+        }
+        # login fields hashed with a PasswordHasher are salted, so they are
+        # verified against the stored hash instead of being part of the lookup
+        self._password_hashers = {
+            c_name: hash_func
+            for c_name, hash_func in self.__class_builder.validators['login_schema']['hash'].items()
+            if isinstance(hash_func, PasswordHasher)
+        }
+        # login fields without hash_func identify the account for login_rate_limiter
+        self._login_hashed = set(self.__class_builder.validators['login_schema']['hash'])
+        self._hash_funcs['login_schema'] = {
+            c_name: hash_func for c_name, hash_func in self._hash_funcs['login_schema'].items()
+            if c_name not in self._password_hashers
+        }
 
         self.user_model, self.login_model, self.register_model = \
-            self.__class_builder.build_schemas()
+            self.__class_builder.build_schemas(hash_validators=False)
 
         self.user_db, self.user_rights_db, self.right_list, self._identity_column = \
-            self.__class_builder.build_sql_models(sql_schema_name)
+            self.__class_builder.build_sql_models(sql_schema_name, rights_column, login_filter)
+        # rights_column keeps the user's direct rights as a mask of rights.bit on
+        # the user row instead of user_rights rows
+        self._rights_column = rights_column
+        # with role_tables users get a user_roles row per role, role rights are
+        # expanded from the cached role_rights instead of copied to user_rights
+        self.role_list = self.role_rights_db = self.user_roles_db = None
+        if role_tables:
+            self.role_list, self.role_rights_db, self.user_roles_db = \
+                self.__class_builder.build_role_tables(sql_schema_name)
 
         if self._use_session is True:
-            if redis is None:
+            if session_store is None and redis is not None:
+                session_store = RedisSessionStore(redis)
+            self._session_store = session_store
+            if session_store is None:
                 self._sessions = self.__class_builder.build_session_storage(sql_schema_name)
-            else:
-                self.get_session = self.throw_self(self.__methods_builder.build_get_session(redis=redis))
+            self.get_session = self.throw_self(
+                self.__methods_builder.build_get_session(session_store=session_store))
+            self.create_session = self.throw_self(
+                self.__methods_builder.build_create_session(session_store=session_store))
+            self.rotate_session = self.throw_self(
+                self.__methods_builder.build_rotate_session(session_store=session_store))
+            self.access_cache = TTLCache(maxsize=access_cache_size, ttl=access_cache_ttl)
         if self._use_jwt is True:
             self._secret_key = jwt_secret_key
+            self._jwt_algorithm = jwt_algorithm
+            # keys generated per process would make every worker sign and publish
+            # its own, so asymmetric keys are loaded by the caller into jwt_keys
+            if jwt_algorithm != 'HS256' and jwt_keys is None:
+                raise ArgumentsError(f'jwt_algorithm {jwt_algorithm} needs jwt_keys with the keys'
+                                     f' shared by every worker')
+            # a rotated out key must outlive every token it signed
+            if jwt_keys is not None and jwt_keys.overlap is None:
+                jwt_keys.overlap = refresh_lifetime
+            elif jwt_keys is not None and jwt_keys.overlap < refresh_lifetime:
+                raise ArgumentsError('jwt_keys.overlap must be at least refresh_lifetime')
+            self.jwt_keys = jwt_keys
+            if jwt_keys is not None:
+                self._jwt_algorithm = jwt_keys.algorithm
+            # used refresh token ids are remembered until the token expires,
+            # share the store between workers (redis) to reject reuse everywhere
+            if session_store is None:
+                session_store = MemorySessionStore() if redis is None else RedisSessionStore(redis)
+            self._refresh_store = session_store
+            # verified tokens are kept for access_cache_ttl, never past their own exp
+            self.access_cache = TTLCache(
+                maxsize=access_cache_size,
+                ttl=min(access_cache_ttl, access_lifetime.total_seconds())
+            )
+        self._perms_bitmask = perms_bitmask and self._use_jwt
+        # checked before any body hashing or db work: per client ip on /login and
+        # /register, per account identifier on /login
+        self._ip_rate_limiter = ip_rate_limiter
+        self._login_rate_limiter = login_rate_limiter
+        self._access_lifetime = access_lifetime
+        self._refresh_lifetime = refresh_lifetime
+        self._identity_python_type = \
+            self.user_db.__table__.c[self._identity_column].type.python_type
+        # per worker Bloom filter of login identifiers. a miss catches up on the
+        # rows written since the last fill (user.login_xid) before /login answers
+        # without the login query, so users written by other workers are never
+        # rejected
+        self._use_login_filter = login_filter
+        self._login_filter = None
+        self._login_filter_fp_rate = login_filter_fp_rate
+        self._login_filter_max_bytes = login_filter_max_bytes
+        self._login_filter_xmin = None
+        self._login_filter_queued = None
+        self._login_filter_running = None
+        self._login_identifiers = tuple(
+            c_name for c_name in self.login_model.model_fields if c_name not in self._login_hashed)
 
         self.metadata = self.__class_builder.metadata
         self.permissions, self.roles = self.__class_builder.parse_roles()
+        # name -> rights.bit, loaded by sync_rights/refresh_rights
+        self._perms_bits = {}
+        self._rights_index = {}
+        self._rights_names = {}
+        self._roles_index = {}
+        self._role_rights = {}
+
+        self._lookup_statements = {}
+        for c_name in self.user_db.__table__.c.keys():
+            self.lookup_statement(self.user_db, [c_name])
+        if getattr(self, '_sessions', None) is not None:
+            for c_name in ('access', 'refresh', 'user_id'):
+                self.lookup_statement(self._sessions, [c_name])
 
-        if self.async_usage is True:
-            self.router = self.__async_router()
+        self.router = self.__async_router()
 
 
         # self.__methods_builder = MethodBuilder(self.session,
@@ -126,12 +286,26 @@ class AuthApp:
         #                                        self._use_jwt)
         self.get_user_by = self.throw_self(self.__methods_builder.build_get_user_by())
         self.get_users_by = self.throw_self(self.__methods_builder.build_get_users_by())
+        self.authenticate = self.throw_self(self.__methods_builder.build_authenticate())
+        self.login_user = self.throw_self(self.__methods_builder.build_login_user())
         self.create_user = self.throw_self(self.__methods_builder.build_create_user())
+        self.create_users = self.throw_self(self.__methods_builder.build_create_users())
         self.update_user = self.throw_self(self.__methods_builder.build_update_user())
         self.delete_user = self.throw_self(self.__methods_builder.build_delete_user())
+        self.resolve_access = self.throw_self(self.__methods_builder.build_resolve_access())
         self.login_required = self.throw_self(self.__methods_builder.build_login_required())
         self.get_user_rights = self.throw_self(self.__methods_builder.build_get_user_rights())
         self.get_rights_id_by_names = self.throw_self(self.__methods_builder.build_get_rights_id_by_names())
+        self.refresh_rights = self.throw_self(self.__methods_builder.build_refresh_rights())
+        self.reconcile_rights = self.throw_self(self.__methods_builder.build_reconcile_rights())
+        self.reconcile_roles = self.throw_self(self.__methods_builder.build_reconcile_roles())
+        self.grant_rights = self.throw_self(self.__methods_builder.build_grant_rights())
+        self.revoke_rights = self.throw_self(self.__methods_builder.build_revoke_rights())
+        self.load_users = self.throw_self(self.__methods_builder.build_load_users())
+        self.load_users_rights = self.throw_self(self.__methods_builder.build_load_users_rights())
+        self.fill_login_filter = self.throw_self(self.__methods_builder.build_fill_login_filter())
+        self.user_loader = BatchLoader(partial(self.call_db, self.load_users))
+        self.rights_loader = BatchLoader(partial(self.call_db, self.load_users_rights))
         #todo какая то хрень с поиском прав. Надо чтобы при логине в токен клались id, а при проверке id брались, основываясь на perms[]
 
     def throw_self(self, func):
@@ -141,6 +315,296 @@ class AuthApp:
             return r
         return inner
 
+    def invalidate_rights(self):
+        self._rights_index = {}
+        self._rights_names = {}
+        self._roles_index = {}
+        self._role_rights = {}
+
+    def generate_models(self) -> str:
+        if self._models_hash is None or self._models_path is None:
+            raise ArgumentsError('codegen needs user_model and role_model defined in a source file')
+        role_tables = None
+        if self.role_list is not None:
+            role_tables = (self.role_list, self.role_rights_db, self.user_roles_db)
+        return codegen.render(
+            self.__class_builder,
+            self._models_hash,
+            hash_validators=False,
+            schemas=(self.user_model, self.login_model, self.register_model),
+            sql_models=(self.user_db, self.user_rights_db, self.right_list, self._identity_column),
+            session_storage=getattr(self, '_sessions', None),
+            role_tables=role_tables,
+        )
+
+    def write_models(self) -> str:
+        source = self.generate_models()
+        with open(self._models_path, 'w') as f:
+            f.write(source)
+        return self._models_path
+
+    def lookup_statement(self, model, keys) -> Select:
+        # one parameterized select per set of columns, reused across requests so
+        # the compiled SQL cache and asyncpg's prepared statement cache always hit
+        keys = tuple(sorted(keys))
+        statement = self._lookup_statements.get((model, keys))
+        if statement is None:
+            table = model.__table__
+            for key in keys:
+                if key not in table.c:
+                    raise ArgumentsError(f'{table.name} has no column {key}')
+            statement = select(model).where(*[table.c[key] == bindparam(key) for key in keys])
+            self._lookup_statements[(model, keys)] = statement
+        return statement
+
+    def login_statement(self, keys) -> Select:
+        # identity and PasswordHasher columns; in JWT mode also the direct rights
+        # (array of right ids or the rights mask) and the role ids with role_tables,
+        # session mode loads the rights on access instead
+        keys = tuple(sorted(keys))
+        statement = self._lookup_statements.get(('login', keys))
+        if statement is None:
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            for key in keys:
+                if key not in table.c:
+                    raise ArgumentsError(f'{table.name} has no column {key}')
+            columns = [identity, *[table.c[c_name] for c_name in self._password_hashers]]
+            if self._use_jwt and self._rights_column:
+                columns.append(table.c.rights)
+            elif self._use_jwt:
+                columns.append(
+                    select(func.array_agg(self.user_rights_db.c.right_id))
+                    .where(self.user_rights_db.c.user_id == identity)
+                    .scalar_subquery()
+                )
+            if self._use_jwt and self.user_roles_db is not None:
+                columns.append(
+                    select(func.array_agg(self.user_roles_db.c.role_id))
+                    .where(self.user_roles_db.c.user_id == identity)
+                    .scalar_subquery()
+                )
+            statement = select(*columns).where(*[table.c[key] == bindparam(key) for key in keys])
+            self._lookup_statements[('login', keys)] = statement
+        return statement
+
+    def users_rights_statement(self) -> Any:
+        # (user id, right id or rights mask, False) rows for the users in the
+        # expanding `ids` param, plus (user id, role id, True) with role_tables
+        statement = self._lookup_statements.get('users_rights')
+        if statement is None:
+            ids = bindparam('ids', expanding=True)
+            if self._rights_column:
+                table = self.user_db.__table__
+                identity = table.c[self._identity_column]
+                statement = select(identity, table.c.rights).where(identity.in_(ids))
+            else:
+                statement = select(self.user_rights_db.c.user_id, self.user_rights_db.c.right_id)\
+                    .where(self.user_rights_db.c.user_id.in_(ids))
+            statement = statement.add_columns(false().label('via_role'))
+            if self.user_roles_db is not None:
+                # direct grants and role ids in one round trip, told apart by via_role
+                statement = union_all(
+                    statement,
+                    select(self.user_roles_db.c.user_id, self.user_roles_db.c.role_id,
+                           true().label('via_role'))
+                    .where(self.user_roles_db.c.user_id.in_(ids))
+                )
+            self._lookup_statements['users_rights'] = statement
+        return statement
+
+    def perms_to_mask(self, perms: list) -> int:
+        mask = 0
+        for p in perms:
+            bit = self._perms_bits.get(p)
+            # _perms_bits is loaded from rights.bit, apps passing their own
+            # lifespan= don't run the router's on_startup hooks
+            if bit is None:
+                raise ArgumentsError(f'permission {p} has no bit loaded,'
+                                     f' call AuthApp.startup() or sync_rights() first')
+            mask |= 1 << bit
+        return mask
+
+    def mask_to_perms(self, mask: int) -> list:
+        return [p for p, bit in self._perms_bits.items() if mask >> bit & 1]
+
+    async def call_db(self, method: Callable, *args, **kwargs) -> Any:
+        if self._async_db:
+            async with self.get_async_session() as db:
+                return await method(db, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._db_executor,
+            partial(self._call_sync, method, *args, **kwargs)
+        )
+
+    def _call_sync(self, method: Callable, *args, **kwargs) -> Any:
+        with self.__sessionmaker() as db:
+            return method(db, *args, **kwargs)
+
+    async def call_sessions(self, method: Callable, *args, **kwargs) -> Any:
+        if self._session_store is None:
+            return await self.call_db(method, *args, **kwargs)
+        return await method(None, *args, **kwargs)
+
+    async def resolve_rights(self, names: list) -> list:
+        if all(n in self._rights_index for n in names):
+            return [self._rights_index[n] for n in names]
+        return await self.call_db(self.get_rights_id_by_names, names)
+
+    async def encode_perms(self, rights: list) -> list | str:
+        if not self._perms_bitmask:
+            return rights
+        if any(r not in self._rights_names for r in rights):
+            await self.call_db(self.refresh_rights)
+        return encode_perms_mask(
+            self.perms_to_mask([self._rights_names[r] for r in rights
+                                if r in self._rights_names])
+        )
+
+    def model_hash_funcs(self, model: BaseModel) -> dict:
+        if isinstance(model, self.login_model):
+            return self._hash_funcs['login_schema']
+        return self._hash_funcs['register_schema']
+
+    async def hash_model(self, model: BaseModel) -> BaseModel:
+        hash_funcs = self.model_hash_funcs(model)
+        if not hash_funcs:
+            return model
+        loop = asyncio.get_running_loop()
+        update = {}
+        for c_name, hash_func in hash_funcs.items():
+            value = getattr(model, c_name)
+            if value is not None:
+                update[c_name] = await loop.run_in_executor(self._hash_executor, hash_func, value)
+        return model.model_copy(update=update)
+
+    def hash_models_sync(self, models: list) -> list:
+        # sync backend: called from a db_executor thread, every value is submitted
+        # to hash_executor before waiting on any of them
+        pending = [
+            {c_name: self._hash_executor.submit(hash_func, getattr(model, c_name))
+             for c_name, hash_func in self.model_hash_funcs(model).items()
+             if getattr(model, c_name) is not None}
+            for model in models
+        ]
+        return [
+            model.model_copy(update={c_name: f.result() for c_name, f in futures.items()})
+            if futures else model
+            for model, futures in zip(models, pending)
+        ]
+
+    def run_hash_sync(self, func: Callable, *args) -> Any:
+        return self._hash_executor.submit(func, *args).result()
+
+    def decode_token(self, token: str) -> dict:
+        if self.jwt_keys is None:
+            key = self._secret_key
+        else:
+            key = self.jwt_keys.verification_key(jwt.get_unverified_header(token).get('kid'))
+            if key is None:
+                raise InvalidSignatureError('Unknown kid')
+        return jwt.decode(token, key=key, algorithms=[self._jwt_algorithm])
+
+    async def issue_tokens(self, uid, rights: list = None) -> Tuple[str, str]:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if rights is None:
+            rights = await self.rights_loader.load(uid)
+        access = self.encode_token({
+            'uid': uid,
+            'exp': now + self._access_lifetime,
+            'perms': await self.encode_perms(rights)
+        })
+        refresh = self.encode_token({
+            'uid': uid,
+            'exp': now + self._refresh_lifetime,
+            'typ': 'refresh',
+            'jti': uuid.uuid4().hex
+        })
+        return access, refresh
+
+    def encode_token(self, payload: dict) -> str:
+        if self.jwt_keys is None:
+            return jwt.encode(payload=payload, key=self._secret_key,
+                              algorithm=self._jwt_algorithm)
+        kid, key = self.jwt_keys.signing_key()
+        return jwt.encode(payload=payload, key=key, algorithm=self._jwt_algorithm,
+                          headers={'kid': kid})
+
+    async def sync_rights(self) -> list:
+        # inserts permissions of role_model missing from the rights table and
+        # reloads the rights index, returns the inserted names
+        return await self.call_db(self.reconcile_rights)
+
+    async def startup(self):
+        await self.sync_rights()
+        if self._use_login_filter:
+            await self.call_db(self.fill_login_filter)
+
+    def add_login_identifiers(self, values: dict):
+        if self._login_filter is None:
+            return
+        for c_name in self._login_identifiers:
+            if values.get(c_name) is not None:
+                self._login_filter.add(f'{c_name}:{values[c_name]}')
+
+    async def known_login(self, user: BaseModel) -> bool:
+        # False only if no user had these identifiers when the request came in,
+        # deleted users stay "known" until the filter is rebuilt
+        if self._login_filter is None:
+            return True
+        items = [f'{c_name}:{value}' for c_name, value in
+                 user.model_dump(include=set(self._login_identifiers), exclude_none=True).items()]
+        if all(item in self._login_filter for item in items):
+            return True
+        try:
+            await self.sync_login_filter()
+        except Exception:
+            # can't tell, the login query decides
+            return True
+        return all(item in self._login_filter for item in items)
+
+    async def sync_login_filter(self):
+        # a miss waits for a catch-up started after it, misses arriving meanwhile
+        # share the next one: at most one catch-up runs and one is queued
+        if self._login_filter_queued is None:
+            self._login_filter_queued = asyncio.ensure_future(self._next_login_filter_sync())
+        await asyncio.shield(self._login_filter_queued)
+
+    async def _next_login_filter_sync(self):
+        if self._login_filter_running is not None:
+            await asyncio.wait([self._login_filter_running])
+        self._login_filter_queued = None
+        self._login_filter_running = asyncio.current_task()
+        try:
+            login_filter = self._login_filter
+            # rebuilt with a bigger capacity once the expected fp rate is exceeded
+            after = self._login_filter_xmin if login_filter.count <= login_filter.capacity else None
+            await self.call_db(self.fill_login_filter, after)
+        finally:
+            self._login_filter_running = None
+
+    async def limit_ip(self, request: Request) -> JSONResponse | None:
+        if self._ip_rate_limiter is None:
+            return None
+        host = request.client.host if request.client is not None else 'unknown'
+        retry = await self._ip_rate_limiter.hit(f'ip:{host}')
+        if retry:
+            return JSONResponse({'msg': 'Too many requests'}, status_code=429,
+                                headers={'Retry-After': str(math.ceil(retry))})
+        return None
+
+    async def limit_login(self, user: BaseModel) -> JSONResponse | None:
+        if self._login_rate_limiter is None:
+            return None
+        identifier = user.model_dump(exclude=self._login_hashed, exclude_none=True)
+        key = '&'.join(f'{k}={v}' for k, v in sorted(identifier.items()))
+        retry = await self._login_rate_limiter.hit(f'login:{key}')
+        if retry:
+            return JSONResponse({'msg': 'Too many login attempts'}, status_code=429,
+                                headers={'Retry-After': str(math.ceil(retry))})
+        return None
+
     def get_sync_session(self):
         db = self.__sessionmaker()
         try:
@@ -161,46 +625,116 @@ class AuthApp:
             await conn.close()
 
     def __async_router(self):
-        route = APIRouter(prefix=self.__prefix)
+        route = APIRouter(prefix=self.__prefix, on_startup=[self.startup])
         register_model = self.register_model
         login_model = self.login_model
 
+        # rate limits run before any hashing or db work, parsing the body hashes nothing
         @route.post('/register')
-        async def register(user: register_model):
-            async with self.get_async_session() as db:
-                r = await self.create_user(db, user)
+        async def register(request: Request, user: register_model):
+            limited = await self.limit_ip(request)
+            if limited is not None:
+                return limited
+            r = await self.call_db(self.create_user, user)
             return JSONResponse(r)
 
         if self._use_session is True:
             @route.post('/login')
-            async def login(user: login_model = None,
+            async def login(request: Request,
+                            user: login_model = None,
                             access: Annotated[Union[str, None], Cookie()] = None,
                             refresh: Annotated[Union[str, None], Cookie()] = None
                             ):
-                async with self.get_async_session() as db:
-                    if access is not None:
-                        session = await self.get_session(access)
-                    elif refresh is not None:
-                        pass
-                    elif user is not None:
-                        user = await self.get_users_by(db, **user.model_dump())
-                return JSONResponse({'msg': 'No data have given'}, status_code=400)
+                limited = await self.limit_ip(request)
+                if limited is not None:
+                    return limited
+                if access is not None and user is None:
+                    payload = await self.resolve_access(access)
+                    if not isinstance(payload, JSONResponse):
+                        return JSONResponse({'msg': 'Already logged in'}, status_code=200)
+                tokens = None
+                if refresh is not None and user is None:
+                    tokens = await self.call_sessions(self.rotate_session, refresh)
+                    if tokens is None:
+                        return JSONResponse({'msg': 'Invalid refresh token'},
+                                            status_code=403)
+                elif user is not None:
+                    limited = await self.limit_login(user)
+                    if limited is not None:
+                        return limited
+                    if not await self.known_login(user):
+                        return JSONResponse({'msg': 'wrong data'},
+                                            status_code=400)
+                    login = await self.call_db(self.login_user, user)
+                    if login is None:
+                        return JSONResponse({'msg': 'wrong data'},
+                                            status_code=400)
+                    tokens = await self.call_sessions(self.create_session, login[0])
+                if tokens is None:
+                    return JSONResponse({'msg': 'No data have given'}, status_code=400)
+                response = JSONResponse({'msg': 'Successful login!'}, status_code=200)
+                response.set_cookie('access', tokens[0], httponly=True,
+                                    max_age=int(self._access_lifetime.total_seconds()))
+                response.set_cookie('refresh', tokens[1], httponly=True,
+                                    max_age=int(self._refresh_lifetime.total_seconds()))
+                return response
+
+        if self._use_jwt is True and self.jwt_keys is not None:
+            @route.get('/.well-known/jwks.json')
+            async def jwks():
+                return JSONResponse(self.jwt_keys.jwks(),
+                                    headers={'Cache-Control': 'public, max-age=300'})
 
         if self._use_jwt is True:
             @route.post('/login')
-            async def login(user: login_model):
-                async with self.get_async_session() as db:
-                    user = await self.get_user_by(db, **user.model_dump())
-                    if user is None:
-                        return JSONResponse({'msg': 'wrong data'},
-                                            status_code=400)
-                    payload = {
-                        'uid': getattr(user, self._identity_column),
-                        'exp': datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(minutes=15),
-                        'perms': await self.get_user_rights(db, getattr(user, self._identity_column))
-                    }
-                token = jwt.encode(payload=payload, key=self._secret_key)
-                return JSONResponse({'msg': 'Successful login!', 'token': token},
+            async def login(request: Request, user: login_model):
+                limited = await self.limit_ip(request) or await self.limit_login(user)
+                if limited is not None:
+                    return limited
+                if not await self.known_login(user):
+                    return JSONResponse({'msg': 'wrong data'},
+                                        status_code=400)
+                login = await self.call_db(self.login_user, user)
+                if login is None:
+                    return JSONResponse({'msg': 'wrong data'},
+                                        status_code=400)
+                access, refresh = await self.issue_tokens(*login)
+                return JSONResponse({'msg': 'Successful login!',
+                                     'token': access,
+                                     'refresh': refresh},
+                                    status_code=200)
+
+            @route.post('/refresh')
+            async def refresh_token(refresh: Annotated[Union[str, None], Body(embed=True)] = None,
+                              refresh_cookie: Annotated[Union[str, None],
+                                                        Cookie(alias='refresh')] = None):
+                refresh = refresh or refresh_cookie
+                if refresh is None:
+                    return JSONResponse({'msg': 'refresh token not found'},
+                                        status_code=400)
+                try:
+                    payload = self.decode_token(refresh)
+                except ExpiredSignatureError:
+                    return JSONResponse({'msg': 'refresh token expired'},
+                                        status_code=403)
+                except InvalidTokenError:
+                    return JSONResponse({'msg': 'Invalid refresh token'},
+                                        status_code=403)
+                if payload.get('typ') != 'refresh':
+                    return JSONResponse({'msg': 'Invalid refresh token'},
+                                        status_code=403)
+                # every refresh token works once, reuse is rejected
+                if not await self._refresh_store.add(
+                        f"refresh:used:{payload['jti']}",
+                        True,
+                        max(int(payload['exp'] - time.time()), 1)
+                ):
+                    return JSONResponse({'msg': 'Invalid refresh token'},
+                                        status_code=403)
+                access, refresh = await self.issue_tokens(payload['uid'])
+                return JSONResponse({'msg': 'Successful refresh!',
+                                     'token': access,
+                                     'refresh': refresh},
                                     status_code=200)
 
         return route
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+# loads issued during one event loop tick are folded into one batch_func call,
+# concurrent loads of the same key share one future, each caller awaits it
+# through asyncio.shield so a cancelled request doesn't cancel the others
+class BatchLoader:
+
+    def __init__(self, batch_func: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]):
+        self._batch_func = batch_func
+        self._pending = {}
+        self._in_flight = {}
+        self._scheduled = False
+
+    def load(self, key: Hashable) -> asyncio.Future:
+        future = self._pending.get(key) or self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._dispatch)
+        return asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        self._scheduled = False
+        batch, self._pending = self._pending, {}
+        self._in_flight.update(batch)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: Dict[Hashable, asyncio.Future]) -> None:
+        try:
+            result = await self._batch_func(list(batch.keys()))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(result.get(key))
+        finally:
+            for key, future in batch.items():
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+                # batch_func itself was cancelled
+                if not future.done():
+                    future.cancel()
@@ -0,0 +1,41 @@
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    # no false negatives, false positives at about fp_rate while count <= capacity.
+    # max_bytes caps the bit array, a tight cap raises the real fp rate instead
+    def __init__(self, capacity: int, fp_rate: float = 0.01, max_bytes: int = None):
+        capacity = max(capacity, 1)
+        bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+        if max_bytes is not None:
+            bits = min(bits, max_bytes * 8)
+        self.capacity = capacity
+        self.size = max(bits, 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        # add() may run in db executor threads, setting a bit is read-modify-write
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        positions = self._positions(item)
+        with self._lock:
+            for p in positions:
+                self._bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
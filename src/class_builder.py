@@ -1,20 +1,50 @@
 import datetime
+import sys
 import uuid
 from typing import Any, Tuple, Set, Dict, Union
 
 from pydantic import BaseModel, create_model, EmailStr, Json
 from pydantic_core import PydanticUndefined
-from pydantic_extra_types.phone_numbers import PhoneNumber
 from sqlalchemy import Column, Identity, Table, ForeignKey, MetaData, BigInteger, Boolean, \
-    String, Float, DateTime, Time, Date, JSON, event
+    String, Float, DateTime, Time, Date, JSON, Index, DDL, event, text
 from sqlalchemy import UUID as sqlUUID
 from sqlalchemy.ext.declarative import declarative_base
 
 from .exceptions import InvalidModel
+from .hashers import PasswordHasher
 from .fields import LoginField, BaseField, RegisterField, IdentityField, ContactField
 from .utils import xor_fields_maker, hash_validator_maker
 
 
+# xid8 of the current transaction, PostgreSQL 13+
+CURRENT_XID_SQL = 'pg_current_xact_id()::text::bigint'
+
+
+def login_xid_trigger(table_name: str, schema: str = None) -> Tuple[list, list]:
+    # statements creating and dropping the trigger that bumps login_xid on every
+    # UPDATE of a user row, whoever runs it (app code, other workers, admin SQL).
+    # it doesn't name the identifier columns, so migrations changing them don't
+    # have to touch it
+    prefix = f'"{schema}".' if schema else ''
+    function = f'{prefix}"{table_name}_login_xid"'
+    create = [
+        f'CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$\n'
+        f'BEGIN\n    NEW.login_xid := {CURRENT_XID_SQL};\n    RETURN NEW;\nEND\n$$',
+        f'CREATE TRIGGER login_xid BEFORE UPDATE ON {prefix}"{table_name}"'
+        f' FOR EACH ROW EXECUTE FUNCTION {function}()',
+    ]
+    return create, [f'DROP FUNCTION IF EXISTS {function}() CASCADE']
+
+
+def attach_login_xid_trigger(table: Table) -> None:
+    # create_all/drop_all run it, alembic revisions get it from env.py
+    create, drop = login_xid_trigger(table.name, table.schema)
+    for statement in create:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    for statement in drop:
+        event.listen(table, 'after_drop', DDL(statement).execute_if(dialect='postgresql'))
+    table.info['login_xid_trigger'] = True
+
 
 type_dict = {
     int: BigInteger,
@@ -27,7 +57,6 @@ type_dict = {
     datetime.date: Date,
     EmailStr: String,
     Json: JSON,
-    PhoneNumber: String,
 }
 
 
@@ -39,6 +68,12 @@ class ClassBuilder:
             role_model: BaseModel = None,
             **kwargs
     ):
+        # phonenumbers is slow to import, a model annotated with PhoneNumber
+        # has already imported it
+        phone_numbers = sys.modules.get('pydantic_extra_types.phone_numbers')
+        if phone_numbers is not None:
+            type_dict.setdefault(phone_numbers.PhoneNumber, String)
+
         self.metadata = MetaData()
         self.Base = declarative_base(metadata=self.metadata)
         if not issubclass(user_model, BaseModel):
@@ -178,7 +213,8 @@ class ClassBuilder:
 
     def build_schema(
             self,
-            by_field_type: LoginField | RegisterField | BaseField = None
+            by_field_type: LoginField | RegisterField | BaseField = None,
+            hash_validators: bool = True
     ) -> BaseModel:
         _validators = {}
         types = {LoginField: 'login_schema', RegisterField: 'register_schema'}
@@ -192,6 +228,10 @@ class ClassBuilder:
                     }
                 )
             for c_name, hash_func in self.validators[types[by_field_type]]['hash'].items():
+                if not hash_validators:
+                    break
+                if by_field_type is LoginField and isinstance(hash_func, PasswordHasher):
+                    continue
                 _validators.update(
                     {
                         f'{c_name}_hash': hash_validator_maker(c_name, hash_func)
@@ -217,16 +257,20 @@ class ClassBuilder:
             **types[by_field_type]
         )
 
-    def build_schemas(self) -> Tuple[BaseModel, BaseModel, BaseModel]:
+    def build_schemas(
+            self,
+            hash_validators: bool = True
+    ) -> Tuple[BaseModel, BaseModel, BaseModel]:
         user_schema = self.build_schema(BaseField)
-        login_schema = self.build_schema(LoginField)
-        register_schema = self.build_schema(RegisterField)
+        login_schema = self.build_schema(LoginField, hash_validators)
+        register_schema = self.build_schema(RegisterField, hash_validators)
         return user_schema, login_schema, register_schema
 
     def build_sql_user_dict(self):
         for c_name, c_info in self.user_model.model_fields.items():
             nullable = True
             unique = False
+            index = False
 
             if 'nullable' in self.user_model.model_config['database_schema'].keys():
                 if c_name in self.user_model.model_config['database_schema']['nullable']:
@@ -236,6 +280,10 @@ class ClassBuilder:
                 if c_name in self.user_model.model_config['database_schema']['unique']:
                     unique = True
 
+            if 'index' in self.user_model.model_config['database_schema'].keys():
+                if c_name in self.user_model.model_config['database_schema']['index']:
+                    index = True
+
             self.user_sql_dict.update(
                 {
                     c_name: {
@@ -245,7 +293,8 @@ class ClassBuilder:
                         'kwargs':
                             {
                                 'unique': unique,
-                                'nullable': nullable
+                                'nullable': nullable,
+                                'index': index
                             }
                     }
                 }
@@ -297,10 +346,19 @@ class ClassBuilder:
 
     def build_sql_models(
             self,
-            schema_name: str = None
+            schema_name: str = None,
+            rights_column: bool = False,
+            login_xid: bool = False
     ) -> Tuple[declarative_base, Table, Table]:
 
         self.build_sql_user_dict()
+        if rights_column:
+            if 'rights' in self.user_sql_dict:
+                raise InvalidModel("User model can't have a 'rights' field with rights_column")
+            if len(self.perms_set) > 63:
+                raise InvalidModel('rights_column holds at most 63 permissions')
+        if login_xid and 'login_xid' in self.user_sql_dict:
+            raise InvalidModel("User model can't have a 'login_xid' field with login_filter")
 
         class DbUser(self.Base):
             __tablename__ = self.user_model.__name__.lower()
@@ -314,14 +372,30 @@ class ClassBuilder:
                 for contact, contact_confirm in self.contacts.items():
                     if contact_confirm:
                         locals()[f'{contact}_confirmed'] = Column(type_dict[bool], default=False)
+            if rights_column:
+                # bit n is set when the user has the permission with rights.bit == n
+                rights = Column(type_dict[int], nullable=False, default=0, server_default='0')
+            if login_xid:
+                # xid8 of the transaction that last wrote the login identifiers, the
+                # login filter catches up on it in commit order (PostgreSQL 13+)
+                login_xid = Column(type_dict[int], nullable=False, index=True,
+                                   server_default=text(CURRENT_XID_SQL),
+                                   onupdate=text(CURRENT_XID_SQL))
             del locals()['c_name']
             del locals()['c_info']
 
+        self.build_user_indexes(DbUser.__table__)
+        if login_xid:
+            attach_login_xid_trigger(DbUser.__table__)
+
         right_list = Table(
             'rights',
             self.metadata,
             Column('id', type_dict[int], Identity(always=True), primary_key=True),
-            Column('name', type_dict[str], unique=True)
+            Column('name', type_dict[str], unique=True),
+            # mask bit of the right in rights_column and bitmask tokens, handed out
+            # once by sync_rights and never renumbered
+            Column('bit', type_dict[int], unique=True)
         )
 
         user_rights = Table(
@@ -330,13 +404,65 @@ class ClassBuilder:
             Column(
                 'user_id',
                 self.user_identity['type'],
-                ForeignKey(f"{self.user_model.__name__.lower()}.{self.user_identity['c_name']}")),
-            Column('right_id', type_dict[int], ForeignKey(right_list.c.id)),
+                ForeignKey(f"{self.user_model.__name__.lower()}.{self.user_identity['c_name']}"),
+                primary_key=True),
+            Column('right_id', type_dict[int], ForeignKey(right_list.c.id), primary_key=True),
+            Index('ix_user_rights_right_id', 'right_id'),
             schema=schema_name,
         )
 
         return DbUser, user_rights, right_list, self.user_identity['c_name']
 
+    def build_user_indexes(self, table: Table) -> None:
+        database_schema = self.user_model.model_config['database_schema']
+        hash_index = database_schema.get('hash_index', [])
+        partial_index = database_schema.get('partial_index', {})
+        for c_name in [*hash_index, *partial_index]:
+            if c_name not in table.c:
+                raise InvalidModel(f'database_schema index on unknown column {c_name}')
+        # hash indexes only serve equality, which is all the login lookups do
+        for c_name in hash_index:
+            Index(f'ix_{table.name}_{c_name}_hash', table.c[c_name], postgresql_using='hash')
+        # {column: where}, e.g. {'email': 'email_confirmed'}
+        for c_name, where in partial_index.items():
+            Index(f'ix_{table.name}_{c_name}_partial', table.c[c_name],
+                  postgresql_where=text(where))
+
+    def build_role_tables(self, schema_name: str = None) -> Tuple[Table, Table, Table]:
+        # users reference roles instead of holding a copy of every role right
+        right_list = self.metadata.tables['rights']
+        role_list = Table(
+            'roles',
+            self.metadata,
+            Column('id', type_dict[int], Identity(always=True), primary_key=True),
+            Column('name', type_dict[str], unique=True),
+            schema=schema_name,
+        )
+
+        role_rights = Table(
+            'role_rights',
+            self.metadata,
+            Column('role_id', type_dict[int], ForeignKey(role_list.c.id), primary_key=True),
+            Column('right_id', type_dict[int], ForeignKey(right_list.c.id), primary_key=True),
+            Index('ix_role_rights_right_id', 'right_id'),
+            schema=schema_name,
+        )
+
+        user_roles = Table(
+            'user_roles',
+            self.metadata,
+            Column(
+                'user_id',
+                self.user_identity['type'],
+                ForeignKey(f"{self.user_model.__name__.lower()}.{self.user_identity['c_name']}"),
+                primary_key=True),
+            Column('role_id', type_dict[int], ForeignKey(role_list.c.id), primary_key=True),
+            Index('ix_user_roles_role_id', 'role_id'),
+            schema=schema_name,
+        )
+
+        return role_list, role_rights, user_roles
+
     def build_session_storage(self, schema_name: str = None) -> declarative_base:
         class Session(self.Base):
             __tablename__ = 'sessions'
@@ -351,6 +477,8 @@ class ClassBuilder:
             )
             access = Column(type_dict[uuid.UUID], unique=True, default=uuid.uuid4)
             refresh = Column(type_dict[uuid.UUID], unique=True, default=uuid.uuid4)
+            access_expires = Column(DateTime(timezone=True))
+            refresh_expires = Column(DateTime(timezone=True))
 
         return Session
 
@@ -0,0 +1,317 @@
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import os
+import sys
+import types
+import typing
+from typing import Any, Dict
+
+from pydantic_core import PydanticUndefined
+from sqlalchemy import Table
+
+from .exceptions import InvalidModel
+from .fields import BaseField
+from .hashers import PasswordHasher
+
+# bump when the generated output changes, so old modules are rebuilt
+GENERATOR_VERSION = 6
+
+
+def _describe(obj: Any) -> str:
+    if isinstance(obj, PasswordHasher):
+        params = ', '.join(f'{k}={_describe(v)}' for k, v in sorted(vars(obj).items())
+                           if not k.startswith('_'))
+        return f'{type(obj).__module__}.{type(obj).__qualname__}({params})'
+    if callable(obj):
+        return f"{getattr(obj, '__module__', None)}.{getattr(obj, '__qualname__', repr(obj))}"
+    return repr(obj)
+
+
+def _hash_funcs(model) -> list:
+    # hashers are usually module level objects, their params may come from
+    # settings (e.g. after calibrate-hash) and differ without a source change
+    funcs = []
+    for name, info in model.model_fields.items():
+        fields = info.default if isinstance(info.default, tuple) else (info.default,)
+        for field in fields:
+            hash_func = field.dict.get('hash_func') if isinstance(field, BaseField) else None
+            if hash_func is not None:
+                funcs.append(f'{name}: {_describe(hash_func)}')
+    return funcs
+
+
+def fingerprint(user_model, role_model, **options) -> str | None:
+    # the whole defining modules, not just the classes, so module level objects
+    # the models reference are covered too
+    try:
+        modules = dict.fromkeys([user_model.__module__, role_model.__module__])
+        sources = [inspect.getsource(sys.modules[m]) for m in modules]
+    except (KeyError, OSError, TypeError):
+        return None
+    hash_funcs = '\n'.join(_hash_funcs(user_model))
+    options = repr(sorted(options.items()))
+    return hashlib.sha256(
+        f'{GENERATOR_VERSION}\n{"".join(sources)}\n{hash_funcs}\n{options}'.encode('utf-8')
+    ).hexdigest()
+
+
+def module_name(user_model) -> str:
+    return f'{user_model.__module__}_auth_models'
+
+
+def module_path(user_model) -> str | None:
+    source = getattr(sys.modules.get(user_model.__module__), '__file__', None)
+    if source is None:
+        return None
+    name = user_model.__module__.rsplit('.', 1)[-1]
+    return os.path.join(os.path.dirname(source), f'{name}_auth_models.py')
+
+
+def load(name: str, source_hash: str | None) -> Any:
+    if source_hash is None:
+        return None
+    try:
+        if importlib.util.find_spec(name) is None:
+            return None
+    except ModuleNotFoundError:
+        return None
+    module = importlib.import_module(name)
+    if getattr(module, 'SOURCE_HASH', None) != source_hash:
+        return None
+    return StaticClassBuilder(module)
+
+
+class StaticClassBuilder:
+    # same interface as ClassBuilder, backed by a module written by render()
+
+    def __init__(self, module):
+        self.module = module
+        self.metadata = module.metadata
+        self.Base = module.Base
+        self.user_identity = module.user_identity
+        self.contacts = module.contacts
+        self.validators = module.validators
+        self.perms_set = module.perms_set
+        self.roles = module.roles
+
+    def parse_roles(self):
+        return self.perms_set, self.roles
+
+    def build_schemas(self, hash_validators: bool = True):
+        return self.module.schemas
+
+    def build_sql_models(self, schema_name: str = None, rights_column: bool = False,
+                         login_xid: bool = False):
+        return self.module.sql_models
+
+    def build_session_storage(self, schema_name: str = None):
+        return self.module.session_storage
+
+    def build_role_tables(self, schema_name: str = None):
+        return self.module.role_tables
+
+
+class _Renderer:
+    def __init__(self):
+        self.imports = {}
+        self.objects = {}
+        self.lines = []
+
+    def ref(self, obj: Any) -> str:
+        if obj is None or obj is type(None):
+            return 'None'
+        name = getattr(obj, '__qualname__', None)
+        module = getattr(obj, '__module__', None)
+        if not name or not module or '<' in name:
+            raise InvalidModel(f'Can not generate code for {obj!r}, '
+                               f'it must be importable by name')
+        top = name.split('.')[0]
+        self.imports.setdefault(module, set()).add(top)
+        return name
+
+    def annotation(self, tp: Any) -> str:
+        origin = typing.get_origin(tp)
+        if origin in (typing.Union, types.UnionType):
+            return ' | '.join(self.annotation(a) for a in typing.get_args(tp))
+        if origin is not None:
+            args = ', '.join(self.annotation(a) for a in typing.get_args(tp))
+            return f'{self.ref(origin)}[{args}]'
+        return self.ref(tp)
+
+    def value(self, obj: Any) -> str:
+        if isinstance(obj, PasswordHasher):
+            if id(obj) not in self.objects:
+                kwargs = ', '.join(f'{k}={self.value(v)}' for k, v in vars(obj).items()
+                                   if not k.startswith('_'))
+                name = f'hasher_{len(self.objects)}'
+                self.lines.append(f'{name} = {self.ref(type(obj))}({kwargs})')
+                self.objects[id(obj)] = name
+            return self.objects[id(obj)]
+        if callable(obj):
+            return self.ref(obj)
+        return repr(obj)
+
+    def sql_type(self, sql_type: Any) -> str:
+        if isinstance(sql_type, type):
+            sql_type = sql_type()
+        self.ref(type(sql_type))
+        return repr(sql_type)
+
+    def column(self, column) -> str:
+        args = [repr(column.name), self.sql_type(column.type)]
+        for fk in column.foreign_keys:
+            args.append(f'{self.ref(fk.__class__)}({fk.target_fullname!r})')
+        if column.identity is not None:
+            args.append(f'{self.ref(type(column.identity))}(always={column.identity.always!r})')
+        if column.primary_key:
+            args.append('primary_key=True')
+        if column.unique:
+            args.append('unique=True')
+        if column.index:
+            args.append('index=True')
+        if not column.primary_key:
+            args.append(f'nullable={column.nullable!r}')
+        if column.default is not None:
+            default = column.default.arg
+            if callable(default):
+                args.append(f'default={self.ref(default)}')
+            else:
+                args.append(f'default={default!r}')
+        if column.server_default is not None:
+            server_default = column.server_default.arg
+            if hasattr(server_default, 'text'):
+                self.imports.setdefault('sqlalchemy', set()).add('text')
+                args.append(f'server_default=text({server_default.text!r})')
+            else:
+                args.append(f'server_default={server_default!r}')
+        if column.onupdate is not None and hasattr(column.onupdate.arg, 'text'):
+            self.imports.setdefault('sqlalchemy', set()).add('text')
+            args.append(f'onupdate=text({column.onupdate.arg.text!r})')
+        return f'    {self.ref(type(column))}({", ".join(args)}),'
+
+    def table(self, var: str, table: Table) -> None:
+        self.ref(Table)
+        self.lines.append(f'{var} = Table(')
+        self.lines.append(f'    {table.name!r},')
+        self.lines.append('    metadata,')
+        for column in table.columns:
+            self.lines.append(self.column(column))
+        for index in table.indexes:
+            if len(index.columns) == 1 and list(index.columns)[0].index:
+                continue
+            args = [repr(index.name), *[repr(c.name) for c in index.columns]]
+            if index.unique:
+                args.append('unique=True')
+            for k, v in index.dialect_kwargs.items():
+                if v is None:
+                    continue
+                if hasattr(v, 'text'):
+                    self.imports.setdefault('sqlalchemy', set()).add('text')
+                    args.append(f'{k}=text({v.text!r})')
+                else:
+                    args.append(f'{k}={v!r}')
+            self.lines.append(f'    {self.ref(type(index))}({", ".join(args)}),')
+        if table.schema:
+            self.lines.append(f'    schema={table.schema!r},')
+        self.lines.append(')')
+        if table.info.get('login_xid_trigger'):
+            self.imports.setdefault('fastapi_auth.src.class_builder', set()).add(
+                'attach_login_xid_trigger')
+            self.lines.append(f'attach_login_xid_trigger({var})')
+        self.lines.append('')
+
+    def schema(self, model, hash_validators: bool, validators: Dict) -> None:
+        self.imports.setdefault('pydantic', set()).update({'BaseModel', 'ConfigDict'})
+        self.imports.setdefault('fastapi_auth.src.utils', set()).update(
+            {'xor_fields_maker', 'hash_validator_maker'})
+        self.lines.append(f'class {model.__name__}(BaseModel):')
+        self.lines.append('    model_config = ConfigDict(arbitrary_types_allowed=True, '
+                          'from_attributes=True)')
+        for name, field in model.model_fields.items():
+            line = f'    {name}: {self.annotation(field.annotation)}'
+            if field.default is not PydanticUndefined:
+                line += f' = {self.value(field.default)}'
+            self.lines.append(line)
+        if validators is not None:
+            for i, xor_fields in enumerate(validators['required_xor']):
+                fields = ', '.join(repr(f) for f in sorted(xor_fields))
+                self.lines.append(f'    req_xor_{i} = xor_fields_maker({fields})')
+            for c_name, hash_func in validators['hash'].items():
+                if not hash_validators:
+                    break
+                if model.__name__ == 'LoginUser' and isinstance(hash_func, PasswordHasher):
+                    continue
+                self.lines.append(f'    {c_name}_hash = hash_validator_maker('
+                                  f'{c_name!r}, {self.value(hash_func)})')
+        self.lines.append('')
+        self.lines.append('')
+
+
+def render(class_builder, source_hash: str, hash_validators: bool,
+           schemas: tuple, sql_models: tuple, session_storage: Any,
+           role_tables: tuple = None) -> str:
+    r = _Renderer()
+    r.imports.setdefault('sqlalchemy', set()).add('MetaData')
+    r.imports.setdefault('sqlalchemy.orm', set()).add('declarative_base')
+
+    validators = []
+    for schema, info in class_builder.validators.items():
+        hash_funcs = ', '.join(f'{c_name!r}: {r.value(f)}' for c_name, f in info['hash'].items())
+        validators.append(f"    {schema!r}: {{'required_xor': {info['required_xor']!r}, "
+                          f"'hash': {{{hash_funcs}}}}},")
+    r.lines += [
+        f'SOURCE_HASH = {source_hash!r}',
+        '',
+        'metadata = MetaData()',
+        'Base = declarative_base(metadata=metadata)',
+        '',
+        f"user_identity = {{'c_name': {class_builder.user_identity['c_name']!r}, "
+        f"'type': {r.sql_type(class_builder.user_identity['type'])}}}",
+        f'contacts = {class_builder.contacts!r}',
+        f'perms_set = {set(class_builder.perms_set)!r}',
+        f'roles = {class_builder.roles!r}',
+        'validators = {',
+    ]
+    r.lines += validators + ['}', '', '']
+
+    table_vars = {}
+    for table in class_builder.metadata.sorted_tables:
+        table_vars[table.key] = f'{table.name}_table'
+        r.table(table_vars[table.key], table)
+    r.lines.append('')
+
+    mapped = {}
+    for mapper in class_builder.Base.registry.mappers:
+        cls = mapper.class_
+        mapped[cls] = cls.__name__
+        r.lines.append(f'class {cls.__name__}(Base):')
+        r.lines.append(f'    __table__ = {table_vars[mapper.local_table.key]}')
+        r.lines += ['', '']
+
+    user_schema, login_schema, register_schema = schemas
+    r.schema(user_schema, hash_validators, None)
+    r.schema(login_schema, hash_validators, class_builder.validators['login_schema'])
+    r.schema(register_schema, hash_validators, class_builder.validators['register_schema'])
+
+    db_user, user_rights, right_list, identity = sql_models
+    if role_tables is not None:
+        role_tables = f"({', '.join(table_vars[t.key] for t in role_tables)})"
+    r.lines += [
+        f"schemas = ({', '.join(m.__name__ for m in schemas)})",
+        f'sql_models = ({mapped[db_user]}, {table_vars[user_rights.key]}, '
+        f'{table_vars[right_list.key]}, {identity!r})',
+        f'session_storage = {mapped[session_storage] if session_storage else None}',
+        f'role_tables = {role_tables}',
+    ]
+
+    header = [
+        '# generated by `python -m fastapi_auth codegen`, do not edit.',
+        '# ignored once the source models change, run codegen again to rebuild.',
+    ]
+    for module, names in sorted(r.imports.items()):
+        if module == 'builtins':
+            continue
+        header.append(f"from {module} import {', '.join(sorted(names))}")
+    return '\n'.join(header + ['', ''] + r.lines) + '\n'
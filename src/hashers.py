@@ -0,0 +1,136 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from typing import Callable
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.b64decode(value + '=' * (-len(value) % 4))
+
+
+class PasswordHasher:
+    algorithm = None
+
+    def __init__(self, salt_size: int = 16, legacy_hash_func: Callable[[str], str] = None):
+        self.salt_size = salt_size
+        # hashes in an unknown format (e.g. hash_sha256 hex digests) are checked
+        # with legacy_hash_func and reported by needs_rehash()
+        self.legacy_hash_func = legacy_hash_func
+        self._dummy = None
+
+    def __call__(self, password: str) -> str:
+        return self.hash(password)
+
+    def params(self) -> tuple:
+        raise NotImplementedError
+
+    @staticmethod
+    def derive(password: str, salt: bytes, *params) -> bytes:
+        raise NotImplementedError
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(self.salt_size)
+        params = self.params()
+        derived = self.derive(password, salt, *params)
+        return '$'.join([self.algorithm, *map(str, params), _b64encode(salt), _b64encode(derived)])
+
+    def verify(self, password: str, encoded: str) -> bool:
+        if encoded is None:
+            return False
+        algorithm, *parts = encoded.split('$')
+        hasher = hashers.get(algorithm)
+        if hasher is None:
+            if self.legacy_hash_func is None:
+                return False
+            return hmac.compare_digest(self.legacy_hash_func(password), encoded)
+        try:
+            *params, salt, derived = parts
+            params = [int(p) for p in params]
+            salt, derived = _b64decode(salt), _b64decode(derived)
+            candidate = hasher.derive(password, salt, *params)
+        except (ValueError, TypeError):
+            return False
+        return hmac.compare_digest(candidate, derived)
+
+    def dummy_verify(self, password: str) -> bool:
+        # the cost of verify() for logins of unknown users, so the response
+        # time doesn't tell whether the account exists
+        if self._dummy is None:
+            self._dummy = self.hash(os.urandom(self.salt_size).hex())
+        self.verify(password, self._dummy)
+        return False
+
+    def needs_rehash(self, encoded: str) -> bool:
+        algorithm, *parts = encoded.split('$')
+        if algorithm != self.algorithm:
+            return True
+        return tuple(parts[:-2]) != tuple(map(str, self.params()))
+
+
+class ScryptHasher(PasswordHasher):
+    algorithm = 'scrypt'
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def params(self) -> tuple:
+        return self.n, self.r, self.p
+
+    @staticmethod
+    def derive(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p, dklen=32)
+
+
+class PBKDF2Hasher(PasswordHasher):
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations: int = 600000, **kwargs):
+        super().__init__(**kwargs)
+        self.iterations = iterations
+
+    def params(self) -> tuple:
+        return self.iterations,
+
+    @staticmethod
+    def derive(password: str, salt: bytes, iterations: int) -> bytes:
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+
+hashers = {
+    ScryptHasher.algorithm: ScryptHasher,
+    PBKDF2Hasher.algorithm: PBKDF2Hasher,
+}
+
+
+def measure_hash(hasher: PasswordHasher, rounds: int = 3) -> float:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.hash('calibration password')
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate_hash(algorithm: str = 'scrypt', target_ms: float = 250) -> PasswordHasher:
+    target_ms = float(target_ms)
+    if algorithm == ScryptHasher.algorithm:
+        n = 2 ** 12
+        while measure_hash(ScryptHasher(n=n * 2)) <= target_ms and n < 2 ** 22:
+            n *= 2
+        return ScryptHasher(n=n)
+    if algorithm == PBKDF2Hasher.algorithm:
+        sample = 100000
+        elapsed = measure_hash(PBKDF2Hasher(iterations=sample))
+        return PBKDF2Hasher(iterations=max(int(sample * target_ms / elapsed), 1000))
+    raise ValueError(f'{algorithm} not in {list(hashers)}')
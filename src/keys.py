@@ -0,0 +1,115 @@
+import datetime
+import hashlib
+import json
+from typing import Any, Dict, Tuple
+
+from .exceptions import ArgumentsError
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+# every worker loads the same keys (PEM from a secret store, files, env) with
+# add_key(). rotation is scheduled through not_before: the newest active key
+# signs, a key rotated out stays valid for verification for `overlap` after its
+# successor became active, and upcoming keys are published in the JWKS early.
+# kids are derived from the public key, so all workers agree on them.
+# overlap=None is filled in with refresh_lifetime by AuthApp, a ring used on
+# its own keeps rotated out keys until they are removed
+class KeyRing:
+
+    algorithms = ('RS256', 'EdDSA')
+
+    def __init__(
+            self,
+            algorithm: str = 'RS256',
+            overlap: datetime.timedelta = None,
+    ):
+        if algorithm not in self.algorithms:
+            raise ArgumentsError(f'{algorithm} not in {self.algorithms}')
+        self.algorithm = algorithm
+        self.overlap = overlap
+        self._keys = {}
+        self._public_keys = {}
+        self._jwks = None
+        self._jwks_kids = None
+
+    def add_key(
+            self,
+            private_key: Any,
+            kid: str = None,
+            not_before: datetime.datetime = None
+    ) -> str:
+        if isinstance(private_key, (str, bytes)):
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+            if isinstance(private_key, str):
+                private_key = private_key.encode('utf-8')
+            private_key = load_pem_private_key(private_key, password=None)
+        public_key = private_key.public_key()
+        if kid is None:
+            from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+            der = public_key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+            kid = hashlib.sha256(der).hexdigest()[:16]
+        if not_before is None:
+            not_before = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        self._keys[kid] = {'private': private_key, 'not_before': not_before}
+        self._public_keys[kid] = public_key
+        self._jwks = None
+        return kid
+
+    def generate_key(self) -> Any:
+        if self.algorithm == 'RS256':
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def _retire_at(self, kid: str, now: datetime.datetime) -> datetime.datetime | None:
+        not_before = self._keys[kid]['not_before']
+        successors = [v['not_before'] for v in self._keys.values()
+                      if not_before < v['not_before'] <= now]
+        if not successors or self.overlap is None:
+            return None
+        return min(successors) + self.overlap
+
+    def signing_key(self) -> Tuple[str, Any]:
+        now = _now()
+        active = [(v['not_before'], kid) for kid, v in self._keys.items() if v['not_before'] <= now]
+        if not active:
+            raise ArgumentsError('KeyRing has no active signing key, load one with add_key()')
+        _, kid = max(active)
+        return kid, self._keys[kid]['private']
+
+    def verification_key(self, kid: str) -> Any:
+        public_key = self._public_keys.get(kid)
+        if public_key is None:
+            return None
+        now = _now()
+        if self._keys[kid]['not_before'] > now:
+            return None
+        retire_at = self._retire_at(kid, now)
+        if retire_at is not None and retire_at <= now:
+            return None
+        return public_key
+
+    def jwks(self) -> Dict[str, list]:
+        now = _now()
+        kids = tuple(kid for kid in self._keys
+                     if (self._retire_at(kid, now) or now) >= now)
+        if self._jwks is None or kids != self._jwks_kids:
+            keys = []
+            for kid in kids:
+                public_key = self._public_keys[kid]
+                # jwt.algorithms defines these only when cryptography is installed
+                if self.algorithm == 'RS256':
+                    from jwt.algorithms import RSAAlgorithm
+                    jwk = json.loads(RSAAlgorithm.to_jwk(public_key))
+                else:
+                    from jwt.algorithms import OKPAlgorithm
+                    jwk = json.loads(OKPAlgorithm.to_jwk(public_key))
+                jwk.update({'kid': kid, 'alg': self.algorithm, 'use': 'sig'})
+                keys.append(jwk)
+            self._jwks = {'keys': keys}
+            self._jwks_kids = kids
+        return self._jwks
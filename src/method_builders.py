@@ -1,20 +1,35 @@
+import asyncio
+import datetime
+import hashlib
 import inspect
+import time
+import uuid
 from functools import wraps, update_wrapper
-from typing import Callable, Coroutine, Annotated, Union
+from typing import Callable, Coroutine, Annotated, Union, TYPE_CHECKING
 
-from asyncpg import UndefinedColumnError
 from fastapi import Depends, background, Cookie
-from jwt import DecodeError, InvalidSignatureError, ExpiredSignatureError
+from jwt import ExpiredSignatureError, InvalidTokenError
 from pydantic import BaseModel
-from sqlalchemy import select, Column, insert
+from sqlalchemy import select, insert, literal, update, delete, tuple_, func, \
+    literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import NoResultFound, IntegrityError
-from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 from starlette.responses import JSONResponse
-import jwt
 
-from .exceptions import ArgumentsError
+from .bloom import BloomFilter
+from .exceptions import ArgumentsError, InvalidModel
+from .utils import decode_perms_mask
+
+# pg_advisory_xact_lock key serializing the rights.bit assignment
+RIGHTS_LOCK_ID = 0x6661757472
+# xid8 of the oldest transaction still running
+SNAPSHOT_XMIN = literal_column('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
 
 class BaseMethodBuilder:
     def __init__(
@@ -40,24 +55,222 @@ class BaseMethodBuilder:
     def build_delete_user(self):
         pass
 
+    def build_resolve_access(self):
+        if self._use_jwt:
+            async def resolve_access(self, access: str):
+                digest = hashlib.blake2b(access.encode('utf-8'), digest_size=16).digest()
+                payload = self.access_cache.get(digest)
+                if payload is not None:
+                    return payload
+                try:
+                    payload = self.decode_token(access)
+                    if payload.get('typ') == 'refresh':
+                        return JSONResponse({'msg': 'Invalid access token'},
+                                            status_code=403)
+                    self.access_cache.set(digest, payload, payload.get('exp'))
+                    return payload
+                except ExpiredSignatureError:
+                    return JSONResponse({'msg': 'access token expired'},
+                                        status_code=403)
+                # bad signature, unknown kid, other algorithm, malformed token
+                except InvalidTokenError:
+                    return JSONResponse({'msg': 'Invalid access token'},
+                                        status_code=403)
+        else:
+            async def resolve_access(self, access: str):
+                payload = self.access_cache.get(access)
+                if payload is not None:
+                    return payload
+                session = await self.call_sessions(self.get_session, access=access)
+                if not session:
+                    return JSONResponse({'msg': 'Invalid access token'},
+                                        status_code=403)
+                if self._session_store is None:
+                    uid = session.user_id
+                    exp = session.access_expires.timestamp()
+                    if exp <= time.time():
+                        return JSONResponse({'msg': 'access token expired'},
+                                            status_code=403)
+                else:
+                    uid = self._identity_python_type(session['user_id'])
+                    exp = None
+                payload = {'uid': uid,
+                           'perms': await self.rights_loader.load(uid),
+                           'exp': exp}
+                self.access_cache.set(access, payload, exp)
+                return payload
+        return resolve_access
+
+    def build_login_required(self):
+        def login_required(
+                self,
+                perms: list = [],
+                roles: list = [],
+                verify_user: bool = True
+        ):
+            for r in roles:
+                if r not in self.roles.keys():
+                    raise ValueError(f'{r} not in roles')
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+
+            def real_wrapper(func):
+                user_params = [k for k, v in func.__annotations__.items()
+                               if v == self.user_model]
+                # verify_user=False trusts the token alone: no db round trip, but
+                # a deleted user keeps access until the token expires
+                load_user = verify_user or bool(user_params)
+                role_rights = [self.roles[r] for r in roles]
+                # rights.bit is loaded by sync_rights on startup, after decoration
+                masks = {}
+
+                @wraps(func)
+                async def wrapper(*args,
+                                  access,
+                                  **kwargs):
+                    if access is None:
+                        return JSONResponse({'msg': 'access token not found'},
+                                            status_code=400)
+                    payload = await self.resolve_access(access)
+                    if isinstance(payload, JSONResponse):
+                        return payload
+
+                    if self._perms_bitmask:
+                        if not masks:
+                            # both or neither, a failed first request retries
+                            perms_mask = self.perms_to_mask(perms)
+                            role_masks = [self.perms_to_mask(r) for r in role_rights]
+                            masks.update(perms=perms_mask, roles=role_masks)
+                        perms_mask, role_masks = masks['perms'], masks['roles']
+                        user_mask = decode_perms_mask(payload['perms'])
+                        if user_mask & perms_mask != perms_mask:
+                            return JSONResponse({'msg': 'not enough rights'},
+                                                status_code=403)
+                        if role_masks and \
+                                not any(user_mask & m == m for m in role_masks):
+                            return JSONResponse({'msg': 'not enough rights'},
+                                                status_code=403)
+                    else:
+                        permissions = await self.resolve_rights(perms)
+                        for p in permissions:
+                            if p not in payload['perms']:
+                                return JSONResponse({'msg': 'not enough rights'},
+                                                    status_code=403)
+
+                        missed = 0
+                        for r in role_rights:
+                            for p in await self.resolve_rights(r):
+                                if p not in payload['perms']:
+                                    missed += 1
+                                    break
+
+                        if missed == len(role_rights) and len(role_rights) != 0:
+                            return JSONResponse({'msg': 'not enough rights'},
+                                                status_code=403)
+
+                    if load_user:
+                        user = await self.user_loader.load(payload['uid'])
+
+                        if user is None:
+                            return JSONResponse({'msg': 'Invalid access token'},
+                                                status_code=403)
+
+                        user = self.user_model.model_validate(user)
+                        for k in user_params:
+                            kwargs.update(
+                                {k: user}
+                            )
+
+                    r = await func(*args, **kwargs)
+                    return r
+
+                sig = inspect.signature(func)
+                params = list(sig.parameters.values())
+                params.append(inspect.Parameter(name='access',
+                                                kind=inspect.Parameter.KEYWORD_ONLY,
+                                                annotation=Annotated[Union[str, None], Cookie()],
+                                                default=None
+                                                ))
+                sig = sig.replace(parameters=tuple(params))
+                wrapper.__signature__ = sig
+                return wrapper
+            return real_wrapper
+        return login_required
+
+    def build_create_session(self, session_store=None):
+        if session_store is None:
+            return self.build_sql_create_session()
+
+        async def create_session(self, db: 'AsyncSession', uid):
+            access, refresh = str(uuid.uuid4()), str(uuid.uuid4())
+            refresh_ttl = int(self._refresh_lifetime.total_seconds())
+            await self._session_store.set_many({
+                f'access:{access}': (
+                    {'user_id': uid, 'refresh': refresh},
+                    int(self._access_lifetime.total_seconds())
+                ),
+                f'refresh:{refresh}': (
+                    {'user_id': uid, 'access': access,
+                     'refresh_expires': time.time() + refresh_ttl},
+                    refresh_ttl
+                ),
+            })
+            return access, refresh
+        return create_session
+
+    def build_rotate_session(self, session_store=None):
+        if session_store is None:
+            return self.build_sql_rotate_session()
+
+        async def rotate_session(self, db: 'AsyncSession', refresh: str):
+            session = await self._session_store.get(f'refresh:{refresh}')
+            if session is None:
+                return None
+            access = str(uuid.uuid4())
+            refresh_ttl = int(session['refresh_expires'] - time.time())
+            if refresh_ttl <= 0:
+                return None
+            await self._session_store.set_many({
+                f'access:{access}': (
+                    {'user_id': session['user_id'], 'refresh': refresh},
+                    int(self._access_lifetime.total_seconds())
+                ),
+                f'refresh:{refresh}': ({**session, 'access': access}, refresh_ttl),
+            })
+            await self._session_store.delete(f"access:{session['access']}")
+            self.access_cache.pop(session['access'])
+            return access, refresh
+        return rotate_session
+
+    def build_get_session(self, session_store=None):
+        if session_store is None:
+            return self.build_sql_get_session()
+
+        async def get_session_by(self, db: 'AsyncSession' = None, **kwargs):
+            if len(kwargs) != 1 or not kwargs.keys() <= {'access', 'refresh'}:
+                raise ArgumentsError('Only access or refresh param required')
+            (key, value), = kwargs.items()
+            session = await self._session_store.get(f'{key}:{value}')
+            if session is None:
+                return []
+            return {**session, key: str(value)}
+        return get_session_by
+
 
 class AsyncMethodBuilder(BaseMethodBuilder):
 
     def build_get_user_by(self):
-        async def get_user_by(self, session: AsyncSession, **kwargs):
-            conditions = []
+        async def get_user_by(self, session: 'AsyncSession', **kwargs):
             if not kwargs:
                 raise ArgumentsError('Unique param required')
             # if len(kwargs) > 1:
             #     raise ArgumentsError('Only one unique param required.'
             #                          ' If you need get more than one user,'
             #                          ' try to use get_users_by()')
-            for key, value in kwargs.items():
-                conditions.append(Column(key) == value)
-
-            query = select(self.user_db).where(*conditions)
+            query = self.lookup_statement(self.user_db, kwargs)
             try:
-                user = (await session.execute(query)).scalars().one()
+                user = (await session.execute(query, kwargs)).scalars().one()
                 return user
             except NoResultFound:
                 return None
@@ -65,13 +278,10 @@ class AsyncMethodBuilder(BaseMethodBuilder):
         return get_user_by
 
     def build_get_users_by(self):
-        async def get_users_by(self, session: AsyncSession, **kwargs):
-            conditions = []
-            for key, value in kwargs.items():
-                conditions.append(Column(key) == value)
-            query = select(self.user_db).where(*conditions)
+        async def get_users_by(self, session: 'AsyncSession', **kwargs):
+            query = self.lookup_statement(self.user_db, kwargs)
             try:
-                users = (await session.execute(query)).scalars().all()
+                users = (await session.execute(query, kwargs)).scalars().all()
                 return users
             except NoResultFound:
                 return []
@@ -79,10 +289,141 @@ class AsyncMethodBuilder(BaseMethodBuilder):
                 return []
         return get_users_by
 
+    def build_authenticate(self):
+        async def authenticate(self, db: 'AsyncSession', user: BaseModel):
+            if not isinstance(user, self.login_model):
+                raise ArgumentsError(f"user must be an instance of {self.login_model},"
+                                     f" not {type(user)}")
+            user = await self.hash_model(user)
+            db_user = await self.get_user_by(
+                db,
+                **user.model_dump(exclude=set(self._password_hashers), exclude_none=True)
+            )
+            if not self._password_hashers:
+                return db_user
+            # release the connection before the KDF, as in login_user
+            if db_user is not None:
+                db.expunge(db_user)
+            await db.rollback()
+            loop = asyncio.get_running_loop()
+            if db_user is None:
+                for c_name, hasher in self._password_hashers.items():
+                    await loop.run_in_executor(self._hash_executor, hasher.dummy_verify,
+                                               getattr(user, c_name))
+                return None
+
+            rehashed = {}
+            for c_name, hasher in self._password_hashers.items():
+                password, stored = getattr(user, c_name), getattr(db_user, c_name)
+                if not await loop.run_in_executor(self._hash_executor,
+                                                  hasher.verify, password, stored):
+                    return None
+                if hasher.needs_rehash(stored):
+                    rehashed[c_name] = await loop.run_in_executor(self._hash_executor,
+                                                                  hasher.hash, password)
+            if rehashed:
+                identity = self.user_db.__table__.c[self._identity_column]
+                query = update(self.user_db.__table__)\
+                    .where(identity == getattr(db_user, self._identity_column))\
+                    .values(**rehashed)
+                await db.execute(query)
+                await db.commit()
+            return db_user
+
+        return authenticate
+
+    def build_login_user(self):
+        async def login_user(self, db: 'AsyncSession', user: BaseModel):
+            # identity, password hashes and (JWT mode) right ids in one round trip,
+            # without hydrating the whole user row; returns (uid, right ids or None)
+            # or None
+            if not isinstance(user, self.login_model):
+                raise ArgumentsError(f"user must be an instance of {self.login_model},"
+                                     f" not {type(user)}")
+            user = await self.hash_model(user)
+            lookup = user.model_dump(exclude=set(self._password_hashers), exclude_none=True)
+            if not lookup:
+                raise ArgumentsError('Unique param required')
+            row = (await db.execute(self.login_statement(lookup), lookup)).one_or_none()
+            # end the read transaction so the pooled connection isn't held idle
+            # in transaction for the whole KDF, the rehash gets its own one
+            await db.rollback()
+            loop = asyncio.get_running_loop()
+            if row is None:
+                for c_name, hasher in self._password_hashers.items():
+                    await loop.run_in_executor(self._hash_executor, hasher.dummy_verify,
+                                               getattr(user, c_name))
+                return None
+            n = len(self._password_hashers)
+            uid, stored = row[0], row[1:n + 1]
+
+            rehashed = {}
+            for (c_name, hasher), hashed in zip(self._password_hashers.items(), stored):
+                password = getattr(user, c_name)
+                if not await loop.run_in_executor(self._hash_executor,
+                                                  hasher.verify, password, hashed):
+                    return None
+                if hasher.needs_rehash(hashed):
+                    rehashed[c_name] = await loop.run_in_executor(self._hash_executor,
+                                                                  hasher.hash, password)
+            if rehashed:
+                identity = self.user_db.__table__.c[self._identity_column]
+                query = update(self.user_db.__table__).where(identity == uid).values(**rehashed)
+                await db.execute(query)
+                await db.commit()
+
+            if not self._use_jwt:
+                return uid, None
+            rights = row[n + 1]
+            role_ids = row[n + 2] if self.user_roles_db is not None else None
+            if self._rights_column:
+                rights = await self.get_rights_id_by_names(db, self.mask_to_perms(rights))
+            rights = list(rights or [])
+            if role_ids:
+                if any(role_id not in self._role_rights for role_id in role_ids):
+                    # roles created after the last sync_rights()
+                    return uid, (await self.load_users_rights(db, [uid]))[uid]
+                for role_id in role_ids:
+                    rights += [r for r in self._role_rights[role_id] if r not in rights]
+            return uid, rights
+
+        return login_user
+
+    def build_fill_login_filter(self):
+        async def fill_login_filter(self, db: 'AsyncSession', after=None):
+            # adds the login identifiers of rows written by transactions with
+            # xid >= after, or of all users into a new filter sized by the table.
+            # the snapshot xmin is read first, every write the scan can't see yet
+            # comes from a transaction with an xid >= it
+            table = self.user_db.__table__
+            xmin = (await db.execute(select(SNAPSHOT_XMIN))).scalar_one()
+            query = select(*[table.c[c_name] for c_name in self._login_identifiers])
+            if after is None:
+                count = (await db.execute(select(func.count()).select_from(table))).scalar_one()
+                login_filter = BloomFilter(
+                    max(count * len(self._login_identifiers) * 2, 1024),
+                    fp_rate=self._login_filter_fp_rate,
+                    max_bytes=self._login_filter_max_bytes
+                )
+            else:
+                login_filter = self._login_filter
+                query = query.where(table.c.login_xid >= after)
+            rows = await db.stream(query.execution_options(yield_per=10000))
+            async for row in rows:
+                for c_name, value in zip(self._login_identifiers, row):
+                    item = f'{c_name}:{value}'
+                    if value is not None and item not in login_filter:
+                        login_filter.add(item)
+            self._login_filter = login_filter
+            self._login_filter_xmin = xmin
+            return login_filter.count
+
+        return fill_login_filter
+
     def build_create_user(self):
         async def create_user(
                 self,
-                db: AsyncSession,
+                db: 'AsyncSession',
                 user: BaseModel,
                 confirm_func: Coroutine[None, BaseModel, None] | Callable[[BaseModel], None] = None,
                 perms: list = [],
@@ -98,47 +439,126 @@ class AsyncMethodBuilder(BaseMethodBuilder):
                 raise ArgumentsError(f"user must be an instance of {self.register_model},"
                                      f" not {type(user)}")
 
-            rights = set()
-            for p in perms:
-                rights.add(p)
-            for p in self.roles[role]:
-                rights.add(p)
-            query = select(self.right_list.c.id).where(self.right_list.c.name.in_(rights))
-            rights = (await db.execute(query)).scalars().all()
-            user = self.user_db(**user.model_dump(exclude_defaults=True))
+            user = await self.hash_model(user)
+            rights = {*perms, *self.roles[role]}
+            if self.user_roles_db is not None:
+                rights = set(perms)
+            identity = self.user_db.__table__.c[self._identity_column]
+            values = user.model_dump(exclude_defaults=True)
+            if self._rights_column:
+                values['rights'] = self.perms_to_mask(rights)
+            query = pg_insert(self.user_db.__table__)\
+                .values(**values)\
+                .on_conflict_do_nothing()\
+                .returning(identity)
             try:
-                db.add(user)
+                uid = (await db.execute(query)).scalar_one_or_none()
+                if uid is not None and rights and not self._rights_column:
+                    grants = select(literal(uid, identity.type), self.right_list.c.id)\
+                        .where(self.right_list.c.name.in_(rights))
+                    query = insert(self.user_rights_db)\
+                        .from_select(['user_id', 'right_id'], grants)
+                    await db.execute(query)
+                if uid is not None and self.user_roles_db is not None:
+                    role_id = select(literal(uid, identity.type), self.role_list.c.id)\
+                        .where(self.role_list.c.name == role)
+                    query = insert(self.user_roles_db)\
+                        .from_select(['user_id', 'role_id'], role_id)
+                    await db.execute(query)
                 await db.commit()
-                await db.refresh(user)
-                # user = self.user_model.model_validate(user)
-                # self
-                # if confirm_func is not None:
-                #     background.BackgroundTasks.add_task(confirm_func, user)
-                # background.BackgroundTasks.add_task(print, 'task task task')
-                # await db.aclose()
-                # return {self._identity_column: getattr(user, self._identity_column)}
             except IntegrityError:
+                # conflicts on unique columns are skipped above, this is any other
+                # constraint (NOT NULL, FK, CHECK)
                 await db.rollback()
-                await db.commit()
                 return {"msg": "This data is invalid!"}
+            if uid is None:
+                return {"msg": "This data is invalid!"}
+            self.add_login_identifiers(values)
+            return {self._identity_column: uid}
 
-            # print(rights)
-            values = []
-            for r in rights:
-                values.append({'user_id': getattr(user, self._identity_column),
-                               'right_id': r})
-            query = insert(self.user_rights_db).values(values)
-            await db.execute(query)
+        return create_user
+
+    def build_create_users(self):
+        async def create_users(
+                self,
+                db: 'AsyncSession',
+                users: list,
+                perms: list = [],
+                role: str = 'default',
+                batch_size: int = 1000
+        ):
+            if role not in self.roles.keys():
+                raise ValueError(f'{role} not in roles')
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            for user in users:
+                if not isinstance(user, self.register_model):
+                    raise ArgumentsError(f"user must be an instance of {self.register_model},"
+                                         f" not {type(user)}")
+
+            users = await asyncio.gather(*[self.hash_model(u) for u in users])
+            direct = {*perms, *self.roles[role]} if self.user_roles_db is None else set(perms)
+            mask = self.perms_to_mask(direct)
+            rights = []
+            if not self._rights_column:
+                rights = await self.get_rights_id_by_names(db, list(direct))
+            if self.user_roles_db is not None:
+                role_id = self._roles_index.get(role)
+                if role_id is None:
+                    query = select(self.role_list.c.id).where(self.role_list.c.name == role)
+                    role_id = (await db.execute(query)).scalar_one()
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            unique = [c.name for c in table.columns if c.unique and not c.primary_key]
+
+            result = [{"msg": "This data is invalid!"}] * len(users)
+            user_rights = []
+            user_roles = []
+            created = []
+            for start in range(0, len(users), batch_size):
+                rows = [u.model_dump() for u in users[start:start + batch_size]]
+                if self._rights_column:
+                    for row in rows:
+                        row['rights'] = mask
+                query = pg_insert(table).values(rows).on_conflict_do_nothing()\
+                    .returning(identity, *[table.c[c] for c in unique])
+                returned = (await db.execute(query)).all()
+                if not unique:
+                    ids = [row[0] for row in returned]
+                else:
+                    # rows skipped by ON CONFLICT are missing from RETURNING,
+                    # so inserted users are matched back by their unique columns
+                    inserted = {tuple(row[1:]): row[0] for row in returned}
+                    ids = [inserted.pop(tuple(row.get(c) for c in unique), None)
+                           for row in rows]
+                for i, uid in enumerate(ids):
+                    if uid is None:
+                        continue
+                    result[start + i] = {self._identity_column: uid}
+                    created.append(rows[i])
+                    user_rights += [{'user_id': uid, 'right_id': r} for r in rights]
+                    if self.user_roles_db is not None:
+                        user_roles.append({'user_id': uid, 'role_id': role_id})
+
+            if user_rights:
+                await db.execute(insert(self.user_rights_db), user_rights)
+            if user_roles:
+                await db.execute(insert(self.user_roles_db), user_roles)
             await db.commit()
-            return {self._identity_column: getattr(user, self._identity_column)}
+            for row in created:
+                self.add_login_identifiers(row)
+            return result
 
-        return create_user
+        return create_users
 
     def build_update_user(self):
-        async def update_user(self, session: AsyncSession, user, confirm_func=None):
+        async def update_user(self, session: 'AsyncSession', user, confirm_func=None):
             if not isinstance(user, self.user_model):
                 raise ArgumentsError(f"user must be an instance of {self.user_model},"
                                      f" not {type(user)}")
+            # new identifiers are let through the login filter before they are committed
+            self.add_login_identifiers(user.model_dump())
             try:
                 user = self.user_db(**user.model_fields())
                 await session.begin()
@@ -152,7 +572,7 @@ class AsyncMethodBuilder(BaseMethodBuilder):
         return update_user
 
     def build_delete_user(self):
-        async def delete_user(self, db: AsyncSession, user, confirm_func=None):
+        async def delete_user(self, db: 'AsyncSession', user, confirm_func=None):
             if not isinstance(user, self.user_model):
                 raise ArgumentsError(f"user must be an instance of {self.user_model},"
                                      f" not {type(user)}")
@@ -167,150 +587,264 @@ class AsyncMethodBuilder(BaseMethodBuilder):
                 return {"msg": "Unexpected error!"}
         return delete_user
 
-    def build_login_required(self):
-        # print(self._use_jwt)
-        if self._use_jwt:
-            def login_required(self, perms: list = [], roles: list = []):
-                for r in roles:
-                    if r not in self.roles.keys():
-                        raise ValueError(f'{r} not in roles')
-                for p in perms:
-                    if p not in self.permissions:
-                        raise ValueError(f'{p} not in permissions')
-
-                def real_wrapper(func):
-                    @wraps(func)
-                    async def wrapper(*args,
-                                      access,
-                                      **kwargs):
-                        if access is not None:
-                            try:
-                                payload = jwt.decode(access,
-                                                   key=self._secret_key,
-                                                   algorithms=['HS256'])
-                            except DecodeError or InvalidSignatureError:
-                                return JSONResponse({'msg': 'Invalid access token'},
-                                                    status_code=403)
-                            except ExpiredSignatureError:
-                                return JSONResponse({'msg': 'access token expired'},
-                                                    status_code=403)
-                        else:
-                            return JSONResponse({'msg': 'access token not found'},
-                                                status_code=400)
-                        getter_roles = []
-                        async with self.get_async_session() as db:
-                            permissions = await self.get_rights_id_by_names(db, perms)
-                            kw = {self._identity_column: payload['uid']}
-                            user = await self.get_user_by(db, **kw)
-                            for r in roles:
-                                getter_roles.append(await self.get_rights_id_by_names(db, self.roles[r]))
+    def build_sql_create_session(self):
+        async def create_session(self, db: 'AsyncSession', uid):
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            values = {'access': uuid.uuid4(),
+                      'refresh': uuid.uuid4(),
+                      'access_expires': now + self._access_lifetime,
+                      'refresh_expires': now + self._refresh_lifetime}
+            query = pg_insert(self._sessions.__table__)\
+                .values(user_id=uid, **values)\
+                .on_conflict_do_update(index_elements=['user_id'], set_=values)
+            await db.execute(query)
+            await db.commit()
+            return str(values['access']), str(values['refresh'])
+        return create_session
 
-                        if user is None:
-                            return JSONResponse({'msg': 'Invalid access token'},
-                                                status_code=403)
+    def build_sql_rotate_session(self):
+        async def rotate_session(self, db: 'AsyncSession', refresh: str):
+            try:
+                refresh = uuid.UUID(refresh)
+            except ValueError:
+                return None
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            sessions = self._sessions.__table__
+            # RETURNING gives the new row, the rotated-out access comes from the
+            # locked pre-update row so it can be dropped from access_cache
+            old = select(sessions.c.refresh, sessions.c.access)\
+                .where(sessions.c.refresh == refresh, sessions.c.refresh_expires > now)\
+                .with_for_update().subquery('old')
+            access = uuid.uuid4()
+            query = update(sessions)\
+                .where(sessions.c.refresh == old.c.refresh)\
+                .values(access=access, access_expires=now + self._access_lifetime)\
+                .returning(old.c.access)
+            old_access = (await db.execute(query)).scalar_one_or_none()
+            await db.commit()
+            if old_access is None:
+                return None
+            self.access_cache.pop(str(old_access))
+            return str(access), str(refresh)
+        return rotate_session
 
-                        user = self.user_model.model_validate(user)
+    def build_sql_get_session(self):
+        async def get_session_by(self, db: 'AsyncSession', **kwargs):
+            query = self.lookup_statement(self._sessions, kwargs)
+            try:
+                session = (await db.execute(query, kwargs)).scalars().one()
+                return session
+            except NoResultFound:
+                return []
+            except:
+                return []
+        return get_session_by
 
-                        if self.user_model in func.__annotations__.values():
-                            for k, v in func.__annotations__.items():
-                                if v == self.user_model:
-                                    kwargs.update(
-                                        {k: user}
-                                    )
-                        for p in permissions:
-                            if p not in payload['perms']:
-                                return JSONResponse({'msg': 'not enough rights'},
-                                                    status_code=403)
+    def build_refresh_rights(self):
+        async def refresh_rights(self, db: 'AsyncSession'):
+            query = select(self.right_list.c.name, self.right_list.c.id, self.right_list.c.bit)
+            rows = (await db.execute(query)).all()
+            self._rights_index = {name: right_id for name, right_id, _ in rows}
+            self._rights_names = {right_id: name for name, right_id, _ in rows}
+            self._perms_bits = {name: bit for name, _, bit in rows if bit is not None}
+            return self._rights_index
+        return refresh_rights
 
-                        missed = 0
-                        for r in getter_roles:
-                            for p in r:
-                                if p not in payload['perms']:
-                                    missed += 1
-                                    break
+    def build_reconcile_rights(self):
+        async def reconcile_rights(self, db: 'AsyncSession'):
+            right_list = self.right_list
+            query = select(right_list.c.name, right_list.c.id, right_list.c.bit)
+            rows = (await db.execute(query)).all()
+            existing = {name for name, _, _ in rows}
+            missing = sorted(p for p in self.permissions if p not in existing)
+            if missing or any(bit is None for _, _, bit in rows):
+                # one worker at a time inserts rights and hands out bits, a bit is
+                # never renumbered so stored masks and issued tokens keep their meaning
+                await db.execute(select(func.pg_advisory_xact_lock(RIGHTS_LOCK_ID)))
+                rows = (await db.execute(query)).all()
+                existing = {name for name, _, _ in rows}
+                missing = sorted(p for p in self.permissions if p not in existing)
+                bit = max((bit for _, _, bit in rows if bit is not None), default=-1)
+                for right_id in sorted(right_id for _, right_id, bit in rows if bit is None):
+                    bit += 1
+                    assign = update(right_list).where(right_list.c.id == right_id).values(bit=bit)
+                    await db.execute(assign)
+                values = []
+                for name in missing:
+                    bit += 1
+                    values.append({'name': name, 'bit': bit})
+                if self._rights_column and bit > 62:
+                    await db.rollback()
+                    raise InvalidModel('rights_column holds at most 63 permissions')
+                if values:
+                    await db.execute(insert(right_list).values(values))
+                await db.commit()
+                rows = (await db.execute(query)).all()
+            self._rights_index = {name: right_id for name, right_id, _ in rows}
+            self._rights_names = {right_id: name for name, right_id, _ in rows}
+            self._perms_bits = {name: bit for name, _, bit in rows}
+            if self.role_list is not None:
+                await self.reconcile_roles(db)
+            return missing
+        return reconcile_rights
 
-                        if missed == len(getter_roles) and len(getter_roles) != 0:
-                            return JSONResponse({'msg': 'not enough rights'},
-                                                status_code=403)
+    def build_reconcile_roles(self):
+        async def reconcile_roles(self, db: 'AsyncSession'):
+            query = select(self.role_list.c.name, self.role_list.c.id)
+            rows = (await db.execute(query)).all()
+            existing = {name for name, _ in rows}
+            missing = [{'name': r} for r in sorted(self.roles) if r not in existing]
+            if missing:
+                query = pg_insert(self.role_list).values(missing).on_conflict_do_nothing()
+                await db.execute(query)
+                query = select(self.role_list.c.name, self.role_list.c.id)
+                rows = (await db.execute(query)).all()
+            roles_index = {name: role_id for name, role_id in rows}
 
-                        r = await func(*args, **kwargs)
-                        return r
-
-                    sig = inspect.signature(func)
-                    params = list(sig.parameters.values())
-                    params.append(inspect.Parameter(name='access',
-                                                    kind=inspect.Parameter.KEYWORD_ONLY,
-                                                    annotation=Annotated[Union[str, None], Cookie()],
-                                                    default=None
-                                                    ))
-                    sig = sig.replace(parameters=tuple(params))
-                    wrapper.__signature__ = sig
-                    return wrapper
-                return real_wrapper
-        return login_required
+            # role_model owns the rights of the roles it declares, editing a role
+            # touches its role_rights rows only
+            managed = {roles_index[r] for r in self.roles}
+            desired = {(roles_index[r], self._rights_index[p])
+                       for r, perms in self.roles.items() for p in perms}
+            query = select(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)
+            pairs = {tuple(row) for row in (await db.execute(query)).all()}
+            added = desired - pairs
+            stale = {pair for pair in pairs - desired if pair[0] in managed}
+            if added:
+                query = pg_insert(self.role_rights_db)\
+                    .values([{'role_id': r, 'right_id': p} for r, p in sorted(added)])\
+                    .on_conflict_do_nothing()
+                await db.execute(query)
+            if stale:
+                columns = tuple_(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)
+                query = delete(self.role_rights_db).where(columns.in_(sorted(stale)))
+                await db.execute(query)
+            await db.commit()
 
-    def build_get_session(self, redis=None):
-        if redis is None:
-            async def get_session_by(self, db: AsyncSession, **kwargs):
-                conditions = []
-                for k, v in kwargs.items():
-                    conditions.append(Column(k) == v)
-                query = select(self._sessions).where(*conditions)
-                try:
-                    session = (await db.execute(query)).scalars().one()
-                    return session
-                except NoResultFound:
-                    return []
-                except:
-                    return []
-        else:
-            pass
-        return get_session_by
+            role_rights = {role_id: [] for role_id in roles_index.values()}
+            for role_id, right_id in sorted((pairs - stale) | added):
+                role_rights[role_id].append(right_id)
+            self._roles_index = roles_index
+            self._role_rights = role_rights
+            return role_rights
+        return reconcile_roles
 
     def build_get_rights_id_by_names(self):
-        async def get_rights_id_by_names(self, db: AsyncSession, perms: list):
-            query = select(self.right_list.c.id).where(self.right_list.c.name.in_(perms))
-            try:
-                permissions = (await db.execute(query)).scalars().all()
-                # print(permissions)
-                return permissions
-            except NoResultFound:
-                return []
+        async def get_rights_id_by_names(self, db: 'AsyncSession', perms: list):
+            rights = []
+            missed = []
+            for p in perms:
+                if p in self._rights_index:
+                    rights.append(self._rights_index[p])
+                else:
+                    missed.append(p)
+            if not missed:
+                return rights
+            # names that are not cached yet (added after startup) still go to db
+            query = select(self.right_list.c.name, self.right_list.c.id)\
+                .where(self.right_list.c.name.in_(missed))
+            rows = (await db.execute(query)).all()
+            for name, right_id in rows:
+                self._rights_index[name] = right_id
+                self._rights_names[right_id] = name
+                rights.append(right_id)
+            return rights
         return get_rights_id_by_names
 
     def build_get_user_rights(self):
-        async def get_user_rights(self, db: AsyncSession, uid):
-            subquery = select(self.user_rights_db.c.right_id)
-            query = subquery.where(self.user_rights_db.c.user_id == uid)
-            # print('get_user_rights!!!')
-            # print(query)
-            try:
-                rights = (await db.execute(query)).scalars().all()
-                # print(rights)
-                return rights
-            except NoResultFound:
-                return []
+        async def get_user_rights(self, db: 'AsyncSession', uid):
+            return (await self.load_users_rights(db, [uid]))[uid]
 
         return get_user_rights
 
+    def build_load_users(self):
+        async def load_users(self, db: 'AsyncSession', ids: list):
+            identity = self.user_db.__table__.c[self._identity_column]
+            query = select(self.user_db).where(identity.in_(ids))
+            users = (await db.execute(query)).scalars().all()
+            return {getattr(u, self._identity_column): u for u in users}
+
+        return load_users
+
+    def build_load_users_rights(self):
+        async def load_users_rights(self, db: 'AsyncSession', ids: list):
+            rights = {uid: [] for uid in ids}
+            user_roles = []
+            for uid, ref, via_role in (await db.execute(self.users_rights_statement(), {'ids': ids})).all():
+                if via_role:
+                    user_roles.append((uid, ref))
+                elif self._rights_column:
+                    rights[uid] += await self.get_rights_id_by_names(db, self.mask_to_perms(ref))
+                else:
+                    rights[uid].append(ref)
+            missed = {role_id for _, role_id in user_roles if role_id not in self._role_rights}
+            if missed:
+                # roles created after the last sync_rights()
+                query = select(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)\
+                    .where(self.role_rights_db.c.role_id.in_(missed))
+                role_rights = {role_id: [] for role_id in missed}
+                for role_id, right_id in (await db.execute(query)).all():
+                    role_rights[role_id].append(right_id)
+                self._role_rights.update(role_rights)
+            for uid, role_id in user_roles:
+                user_rights = rights[uid]
+                user_rights += [r for r in self._role_rights[role_id] if r not in user_rights]
+            return rights
+
+        return load_users_rights
+
+    def build_grant_rights(self):
+        async def grant_rights(self, db: 'AsyncSession', uid, perms: list):
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            if self._rights_column:
+                # one atomic UPDATE, concurrent grants can't overwrite each other
+                query = update(table).where(identity == uid)\
+                    .values(rights=table.c.rights.op('|')(self.perms_to_mask(perms)))
+            else:
+                grants = select(literal(uid, identity.type), self.right_list.c.id)\
+                    .where(self.right_list.c.name.in_(perms))
+                query = pg_insert(self.user_rights_db)\
+                    .from_select(['user_id', 'right_id'], grants)\
+                    .on_conflict_do_nothing()
+            await db.execute(query)
+            await db.commit()
+
+        return grant_rights
+
+    def build_revoke_rights(self):
+        async def revoke_rights(self, db: 'AsyncSession', uid, perms: list):
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            if self._rights_column:
+                query = update(table).where(identity == uid)\
+                    .values(rights=table.c.rights.op('&')(~self.perms_to_mask(perms)))
+            else:
+                right_ids = select(self.right_list.c.id).where(self.right_list.c.name.in_(perms))
+                query = delete(self.user_rights_db)\
+                    .where(self.user_rights_db.c.user_id == uid,
+                           self.user_rights_db.c.right_id.in_(right_ids))
+            await db.execute(query)
+            await db.commit()
+
+        return revoke_rights
+
 
 class SyncMethodBuilder(BaseMethodBuilder):
 
     def build_get_user_by(self):
         def get_user_by(self, session: Session, **kwargs):
-            conditions = []
             if not kwargs:
                 raise ArgumentsError('Unique param required')
-            if len(kwargs) > 1:
-                raise ArgumentsError('Only one unique param required.'
-                                     ' If you need get more than one user,'
-                                     ' try to use get_users_by()')
-            for key, value in kwargs.items():
-                conditions.append(Column(key) == value)
-
-            query = select(self.user_db).where(*conditions)
+            query = self.lookup_statement(self.user_db, kwargs)
             try:
-                user = session.execute(query).scalars().one()
+                user = session.execute(query, kwargs).scalars().one()
                 return user
             except NoResultFound:
                 return None
@@ -319,12 +853,9 @@ class SyncMethodBuilder(BaseMethodBuilder):
 
     def build_get_users_by(self):
         def get_users_by(self, session: Session, **kwargs):
-            conditions = []
-            for key, value in kwargs.items():
-                conditions.append(Column(key) == value)
-            query = select(self.user_db).where(*conditions)
+            query = self.lookup_statement(self.user_db, kwargs)
             try:
-                users = session.execute(query).scalars().all()
+                users = session.execute(query, kwargs).scalars().all()
                 return users
             except NoResultFound:
                 return []
@@ -332,29 +863,266 @@ class SyncMethodBuilder(BaseMethodBuilder):
                 return []
         return get_users_by
 
+    def build_authenticate(self):
+        def authenticate(self, db: Session, user: BaseModel):
+            if not isinstance(user, self.login_model):
+                raise ArgumentsError(f"user must be an instance of {self.login_model},"
+                                     f" not {type(user)}")
+            user = self.hash_models_sync([user])[0]
+            db_user = self.get_user_by(
+                db,
+                **user.model_dump(exclude=set(self._password_hashers), exclude_none=True)
+            )
+            if not self._password_hashers:
+                return db_user
+            # release the connection before the KDF, as in login_user
+            if db_user is not None:
+                db.expunge(db_user)
+            db.rollback()
+            if db_user is None:
+                for c_name, hasher in self._password_hashers.items():
+                    self.run_hash_sync(hasher.dummy_verify, getattr(user, c_name))
+                return None
+
+            rehashed = {}
+            for c_name, hasher in self._password_hashers.items():
+                password, stored = getattr(user, c_name), getattr(db_user, c_name)
+                if not self.run_hash_sync(hasher.verify, password, stored):
+                    return None
+                if hasher.needs_rehash(stored):
+                    rehashed[c_name] = self.run_hash_sync(hasher.hash, password)
+            if rehashed:
+                identity = self.user_db.__table__.c[self._identity_column]
+                query = update(self.user_db.__table__)\
+                    .where(identity == getattr(db_user, self._identity_column))\
+                    .values(**rehashed)
+                db.execute(query)
+                db.commit()
+            return db_user
+
+        return authenticate
+
+    def build_login_user(self):
+        def login_user(self, db: Session, user: BaseModel):
+            # identity, password hashes and (JWT mode) right ids in one round trip,
+            # without hydrating the whole user row; returns (uid, right ids or None)
+            # or None
+            if not isinstance(user, self.login_model):
+                raise ArgumentsError(f"user must be an instance of {self.login_model},"
+                                     f" not {type(user)}")
+            user = self.hash_models_sync([user])[0]
+            lookup = user.model_dump(exclude=set(self._password_hashers), exclude_none=True)
+            if not lookup:
+                raise ArgumentsError('Unique param required')
+            row = db.execute(self.login_statement(lookup), lookup).one_or_none()
+            # end the read transaction so the pooled connection isn't held idle
+            # in transaction for the whole KDF, the rehash gets its own one
+            db.rollback()
+            if row is None:
+                for c_name, hasher in self._password_hashers.items():
+                    self.run_hash_sync(hasher.dummy_verify, getattr(user, c_name))
+                return None
+            n = len(self._password_hashers)
+            uid, stored = row[0], row[1:n + 1]
+
+            rehashed = {}
+            for (c_name, hasher), hashed in zip(self._password_hashers.items(), stored):
+                password = getattr(user, c_name)
+                if not self.run_hash_sync(hasher.verify, password, hashed):
+                    return None
+                if hasher.needs_rehash(hashed):
+                    rehashed[c_name] = self.run_hash_sync(hasher.hash, password)
+            if rehashed:
+                identity = self.user_db.__table__.c[self._identity_column]
+                query = update(self.user_db.__table__).where(identity == uid).values(**rehashed)
+                db.execute(query)
+                db.commit()
+
+            if not self._use_jwt:
+                return uid, None
+            rights = row[n + 1]
+            role_ids = row[n + 2] if self.user_roles_db is not None else None
+            if self._rights_column:
+                rights = self.get_rights_id_by_names(db, self.mask_to_perms(rights))
+            rights = list(rights or [])
+            if role_ids:
+                if any(role_id not in self._role_rights for role_id in role_ids):
+                    # roles created after the last sync_rights()
+                    return uid, self.load_users_rights(db, [uid])[uid]
+                for role_id in role_ids:
+                    rights += [r for r in self._role_rights[role_id] if r not in rights]
+            return uid, rights
+
+        return login_user
+
+    def build_fill_login_filter(self):
+        def fill_login_filter(self, db: Session, after=None):
+            # adds the login identifiers of rows written by transactions with
+            # xid >= after, or of all users into a new filter sized by the table.
+            # the snapshot xmin is read first, every write the scan can't see yet
+            # comes from a transaction with an xid >= it
+            table = self.user_db.__table__
+            xmin = db.execute(select(SNAPSHOT_XMIN)).scalar_one()
+            query = select(*[table.c[c_name] for c_name in self._login_identifiers])
+            if after is None:
+                count = db.execute(select(func.count()).select_from(table)).scalar_one()
+                login_filter = BloomFilter(
+                    max(count * len(self._login_identifiers) * 2, 1024),
+                    fp_rate=self._login_filter_fp_rate,
+                    max_bytes=self._login_filter_max_bytes
+                )
+            else:
+                login_filter = self._login_filter
+                query = query.where(table.c.login_xid >= after)
+            rows = db.execute(query.execution_options(yield_per=10000))
+            for row in rows:
+                for c_name, value in zip(self._login_identifiers, row):
+                    item = f'{c_name}:{value}'
+                    if value is not None and item not in login_filter:
+                        login_filter.add(item)
+            self._login_filter = login_filter
+            self._login_filter_xmin = xmin
+            return login_filter.count
+
+        return fill_login_filter
+
     def build_create_user(self):
-        def create_user(self, session: Session, user, confirm_func=None):
-            if not isinstance(user, self.register_user):
-                raise ArgumentsError(f"user must be an instance of {self.register_user},"
+        def create_user(
+                self,
+                db: Session,
+                user: BaseModel,
+                confirm_func: Callable[[BaseModel], None] = None,
+                perms: list = [],
+                role: str = 'default'
+        ):
+            if role not in self.roles.keys():
+                raise ValueError(f'{role} not in roles')
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+
+            if not isinstance(user, self.register_model):
+                raise ArgumentsError(f"user must be an instance of {self.register_model},"
                                      f" not {type(user)}")
-            user = self.user_db(**user)
+
+            user = self.hash_models_sync([user])[0]
+            rights = {*perms, *self.roles[role]}
+            if self.user_roles_db is not None:
+                rights = set(perms)
+            identity = self.user_db.__table__.c[self._identity_column]
+            values = user.model_dump(exclude_defaults=True)
+            if self._rights_column:
+                values['rights'] = self.perms_to_mask(rights)
+            query = pg_insert(self.user_db.__table__)\
+                .values(**values)\
+                .on_conflict_do_nothing()\
+                .returning(identity)
             try:
-                session.begin()
-                session.add(**user)
-                session.commit()
-                session.refresh(user)
-                return getattr(user, self.__identity_column)
+                uid = db.execute(query).scalar_one_or_none()
+                if uid is not None and rights and not self._rights_column:
+                    grants = select(literal(uid, identity.type), self.right_list.c.id)\
+                        .where(self.right_list.c.name.in_(rights))
+                    query = insert(self.user_rights_db)\
+                        .from_select(['user_id', 'right_id'], grants)
+                    db.execute(query)
+                if uid is not None and self.user_roles_db is not None:
+                    role_id = select(literal(uid, identity.type), self.role_list.c.id)\
+                        .where(self.role_list.c.name == role)
+                    query = insert(self.user_roles_db)\
+                        .from_select(['user_id', 'role_id'], role_id)
+                    db.execute(query)
+                db.commit()
             except IntegrityError:
+                # conflicts on unique columns are skipped above, this is any other
+                # constraint (NOT NULL, FK, CHECK)
+                db.rollback()
                 return {"msg": "This data is invalid!"}
-            except:
-                return {"msg": "Unexpected error!"}
+            if uid is None:
+                return {"msg": "This data is invalid!"}
+            self.add_login_identifiers(values)
+            return {self._identity_column: uid}
+
         return create_user
 
+    def build_create_users(self):
+        def create_users(
+                self,
+                db: Session,
+                users: list,
+                perms: list = [],
+                role: str = 'default',
+                batch_size: int = 1000
+        ):
+            if role not in self.roles.keys():
+                raise ValueError(f'{role} not in roles')
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            for user in users:
+                if not isinstance(user, self.register_model):
+                    raise ArgumentsError(f"user must be an instance of {self.register_model},"
+                                         f" not {type(user)}")
+
+            users = self.hash_models_sync(users)
+            direct = {*perms, *self.roles[role]} if self.user_roles_db is None else set(perms)
+            mask = self.perms_to_mask(direct)
+            rights = []
+            if not self._rights_column:
+                rights = self.get_rights_id_by_names(db, list(direct))
+            if self.user_roles_db is not None:
+                role_id = self._roles_index.get(role)
+                if role_id is None:
+                    query = select(self.role_list.c.id).where(self.role_list.c.name == role)
+                    role_id = db.execute(query).scalar_one()
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            unique = [c.name for c in table.columns if c.unique and not c.primary_key]
+
+            result = [{"msg": "This data is invalid!"}] * len(users)
+            user_rights = []
+            user_roles = []
+            created = []
+            for start in range(0, len(users), batch_size):
+                rows = [u.model_dump() for u in users[start:start + batch_size]]
+                if self._rights_column:
+                    for row in rows:
+                        row['rights'] = mask
+                query = pg_insert(table).values(rows).on_conflict_do_nothing()\
+                    .returning(identity, *[table.c[c] for c in unique])
+                returned = db.execute(query).all()
+                if not unique:
+                    ids = [row[0] for row in returned]
+                else:
+                    inserted = {tuple(row[1:]): row[0] for row in returned}
+                    ids = [inserted.pop(tuple(row.get(c) for c in unique), None)
+                           for row in rows]
+                for i, uid in enumerate(ids):
+                    if uid is None:
+                        continue
+                    result[start + i] = {self._identity_column: uid}
+                    created.append(rows[i])
+                    user_rights += [{'user_id': uid, 'right_id': r} for r in rights]
+                    if self.user_roles_db is not None:
+                        user_roles.append({'user_id': uid, 'role_id': role_id})
+
+            if user_rights:
+                db.execute(insert(self.user_rights_db), user_rights)
+            if user_roles:
+                db.execute(insert(self.user_roles_db), user_roles)
+            db.commit()
+            for row in created:
+                self.add_login_identifiers(row)
+            return result
+
+        return create_users
+
     def build_update_user(self):
         def update_user(self, session: Session, user, confirm_func=None):
             if not isinstance(user, self.user_model):
                 raise ArgumentsError(f"user must be an instance of {self.user_model},"
                                      f" not {type(user)}")
+            # new identifiers are let through the login filter before they are committed
+            self.add_login_identifiers(user.model_dump())
             try:
                 user = self.user_db(**user.model_fields())
                 session.begin()
@@ -384,9 +1152,248 @@ class SyncMethodBuilder(BaseMethodBuilder):
                 return {"msg": "Unexpected error!"}
         return delete_user
 
+    def build_sql_create_session(self):
+        def create_session(self, db: Session, uid):
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            values = {'access': uuid.uuid4(),
+                      'refresh': uuid.uuid4(),
+                      'access_expires': now + self._access_lifetime,
+                      'refresh_expires': now + self._refresh_lifetime}
+            query = pg_insert(self._sessions.__table__)\
+                .values(user_id=uid, **values)\
+                .on_conflict_do_update(index_elements=['user_id'], set_=values)
+            db.execute(query)
+            db.commit()
+            return str(values['access']), str(values['refresh'])
+        return create_session
+
+    def build_sql_rotate_session(self):
+        def rotate_session(self, db: Session, refresh: str):
+            try:
+                refresh = uuid.UUID(refresh)
+            except ValueError:
+                return None
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            sessions = self._sessions.__table__
+            # RETURNING gives the new row, the rotated-out access comes from the
+            # locked pre-update row so it can be dropped from access_cache
+            old = select(sessions.c.refresh, sessions.c.access)\
+                .where(sessions.c.refresh == refresh, sessions.c.refresh_expires > now)\
+                .with_for_update().subquery('old')
+            access = uuid.uuid4()
+            query = update(sessions)\
+                .where(sessions.c.refresh == old.c.refresh)\
+                .values(access=access, access_expires=now + self._access_lifetime)\
+                .returning(old.c.access)
+            old_access = db.execute(query).scalar_one_or_none()
+            db.commit()
+            if old_access is None:
+                return None
+            self.access_cache.pop(str(old_access))
+            return str(access), str(refresh)
+        return rotate_session
+
+    def build_sql_get_session(self):
+        def get_session_by(self, db: Session, **kwargs):
+            query = self.lookup_statement(self._sessions, kwargs)
+            try:
+                session = db.execute(query, kwargs).scalars().one()
+                return session
+            except NoResultFound:
+                return []
+            except:
+                return []
+        return get_session_by
+
+    def build_refresh_rights(self):
+        def refresh_rights(self, db: Session):
+            query = select(self.right_list.c.name, self.right_list.c.id, self.right_list.c.bit)
+            rows = db.execute(query).all()
+            self._rights_index = {name: right_id for name, right_id, _ in rows}
+            self._rights_names = {right_id: name for name, right_id, _ in rows}
+            self._perms_bits = {name: bit for name, _, bit in rows if bit is not None}
+            return self._rights_index
+        return refresh_rights
 
+    def build_reconcile_rights(self):
+        def reconcile_rights(self, db: Session):
+            right_list = self.right_list
+            query = select(right_list.c.name, right_list.c.id, right_list.c.bit)
+            rows = db.execute(query).all()
+            existing = {name for name, _, _ in rows}
+            missing = sorted(p for p in self.permissions if p not in existing)
+            if missing or any(bit is None for _, _, bit in rows):
+                # one worker at a time inserts rights and hands out bits, a bit is
+                # never renumbered so stored masks and issued tokens keep their meaning
+                db.execute(select(func.pg_advisory_xact_lock(RIGHTS_LOCK_ID)))
+                rows = db.execute(query).all()
+                existing = {name for name, _, _ in rows}
+                missing = sorted(p for p in self.permissions if p not in existing)
+                bit = max((bit for _, _, bit in rows if bit is not None), default=-1)
+                for right_id in sorted(right_id for _, right_id, bit in rows if bit is None):
+                    bit += 1
+                    assign = update(right_list).where(right_list.c.id == right_id).values(bit=bit)
+                    db.execute(assign)
+                values = []
+                for name in missing:
+                    bit += 1
+                    values.append({'name': name, 'bit': bit})
+                if self._rights_column and bit > 62:
+                    db.rollback()
+                    raise InvalidModel('rights_column holds at most 63 permissions')
+                if values:
+                    db.execute(insert(right_list).values(values))
+                db.commit()
+                rows = db.execute(query).all()
+            self._rights_index = {name: right_id for name, right_id, _ in rows}
+            self._rights_names = {right_id: name for name, right_id, _ in rows}
+            self._perms_bits = {name: bit for name, _, bit in rows}
+            if self.role_list is not None:
+                self.reconcile_roles(db)
+            return missing
+        return reconcile_rights
 
+    def build_reconcile_roles(self):
+        def reconcile_roles(self, db: Session):
+            query = select(self.role_list.c.name, self.role_list.c.id)
+            rows = db.execute(query).all()
+            existing = {name for name, _ in rows}
+            missing = [{'name': r} for r in sorted(self.roles) if r not in existing]
+            if missing:
+                query = pg_insert(self.role_list).values(missing).on_conflict_do_nothing()
+                db.execute(query)
+                query = select(self.role_list.c.name, self.role_list.c.id)
+                rows = db.execute(query).all()
+            roles_index = {name: role_id for name, role_id in rows}
 
+            # role_model owns the rights of the roles it declares, editing a role
+            # touches its role_rights rows only
+            managed = {roles_index[r] for r in self.roles}
+            desired = {(roles_index[r], self._rights_index[p])
+                       for r, perms in self.roles.items() for p in perms}
+            query = select(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)
+            pairs = {tuple(row) for row in db.execute(query).all()}
+            added = desired - pairs
+            stale = {pair for pair in pairs - desired if pair[0] in managed}
+            if added:
+                query = pg_insert(self.role_rights_db)\
+                    .values([{'role_id': r, 'right_id': p} for r, p in sorted(added)])\
+                    .on_conflict_do_nothing()
+                db.execute(query)
+            if stale:
+                columns = tuple_(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)
+                query = delete(self.role_rights_db).where(columns.in_(sorted(stale)))
+                db.execute(query)
+            db.commit()
 
+            role_rights = {role_id: [] for role_id in roles_index.values()}
+            for role_id, right_id in sorted((pairs - stale) | added):
+                role_rights[role_id].append(right_id)
+            self._roles_index = roles_index
+            self._role_rights = role_rights
+            return role_rights
+        return reconcile_roles
+
+    def build_get_rights_id_by_names(self):
+        def get_rights_id_by_names(self, db: Session, perms: list):
+            rights = []
+            missed = []
+            for p in perms:
+                if p in self._rights_index:
+                    rights.append(self._rights_index[p])
+                else:
+                    missed.append(p)
+            if not missed:
+                return rights
+            query = select(self.right_list.c.name, self.right_list.c.id)\
+                .where(self.right_list.c.name.in_(missed))
+            for name, right_id in db.execute(query).all():
+                self._rights_index[name] = right_id
+                self._rights_names[right_id] = name
+                rights.append(right_id)
+            return rights
+        return get_rights_id_by_names
+
+    def build_get_user_rights(self):
+        def get_user_rights(self, db: Session, uid):
+            return self.load_users_rights(db, [uid])[uid]
 
+        return get_user_rights
+
+    def build_load_users(self):
+        def load_users(self, db: Session, ids: list):
+            identity = self.user_db.__table__.c[self._identity_column]
+            query = select(self.user_db).where(identity.in_(ids))
+            users = db.execute(query).scalars().all()
+            return {getattr(u, self._identity_column): u for u in users}
+
+        return load_users
+
+    def build_load_users_rights(self):
+        def load_users_rights(self, db: Session, ids: list):
+            rights = {uid: [] for uid in ids}
+            user_roles = []
+            for uid, ref, via_role in db.execute(self.users_rights_statement(), {'ids': ids}).all():
+                if via_role:
+                    user_roles.append((uid, ref))
+                elif self._rights_column:
+                    rights[uid] += self.get_rights_id_by_names(db, self.mask_to_perms(ref))
+                else:
+                    rights[uid].append(ref)
+            missed = {role_id for _, role_id in user_roles if role_id not in self._role_rights}
+            if missed:
+                # roles created after the last sync_rights()
+                query = select(self.role_rights_db.c.role_id, self.role_rights_db.c.right_id)\
+                    .where(self.role_rights_db.c.role_id.in_(missed))
+                role_rights = {role_id: [] for role_id in missed}
+                for role_id, right_id in db.execute(query).all():
+                    role_rights[role_id].append(right_id)
+                self._role_rights.update(role_rights)
+            for uid, role_id in user_roles:
+                user_rights = rights[uid]
+                user_rights += [r for r in self._role_rights[role_id] if r not in user_rights]
+            return rights
+
+        return load_users_rights
+
+    def build_grant_rights(self):
+        def grant_rights(self, db: Session, uid, perms: list):
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            if self._rights_column:
+                # one atomic UPDATE, concurrent grants can't overwrite each other
+                query = update(table).where(identity == uid)\
+                    .values(rights=table.c.rights.op('|')(self.perms_to_mask(perms)))
+            else:
+                grants = select(literal(uid, identity.type), self.right_list.c.id)\
+                    .where(self.right_list.c.name.in_(perms))
+                query = pg_insert(self.user_rights_db)\
+                    .from_select(['user_id', 'right_id'], grants)\
+                    .on_conflict_do_nothing()
+            db.execute(query)
+            db.commit()
+
+        return grant_rights
+
+    def build_revoke_rights(self):
+        def revoke_rights(self, db: Session, uid, perms: list):
+            for p in perms:
+                if p not in self.permissions:
+                    raise ValueError(f'{p} not in permissions')
+            table = self.user_db.__table__
+            identity = table.c[self._identity_column]
+            if self._rights_column:
+                query = update(table).where(identity == uid)\
+                    .values(rights=table.c.rights.op('&')(~self.perms_to_mask(perms)))
+            else:
+                right_ids = select(self.right_list.c.id).where(self.right_list.c.name.in_(perms))
+                query = delete(self.user_rights_db)\
+                    .where(self.user_rights_db.c.user_id == uid,
+                           self.user_rights_db.c.right_id.in_(right_ids))
+            db.execute(query)
+            db.commit()
 
+        return revoke_rights
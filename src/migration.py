@@ -0,0 +1,83 @@
+import asyncio
+import os
+from typing import Any
+
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from sqlalchemy import create_engine, pool
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session
+
+from .exceptions import ArgumentsError
+
+# env.py and script.py.mako ship with the library, revisions live in the project
+SCRIPT_LOCATION = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'migrations')
+# any constant works, every deploy migrating the same database must use the same one
+LOCK_ID = 0x6661757468
+
+
+def make_config(auth: Any, url: str, directory: str = None) -> Config:
+    if directory is None:
+        directory = os.path.join(os.getcwd(), 'auth_migrations')
+    os.makedirs(directory, exist_ok=True)
+    config = Config()
+    config.set_main_option('script_location', SCRIPT_LOCATION)
+    config.set_main_option('version_locations', directory)
+    config.set_main_option('sqlalchemy.url', url.replace('%', '%%'))
+    config.attributes['target_metadata'] = auth.metadata
+    return config
+
+
+def revision(config: Config, message: str = None) -> Any:
+    # returns None when the metadata matches the database
+    return command.revision(config, message=message or 'fastapi_auth', autogenerate=True)
+
+
+def upgrade(config: Config, target: str = 'head') -> None:
+    command.upgrade(config, target)
+
+
+def downgrade(config: Config, target: str = 'base') -> None:
+    command.downgrade(config, target)
+
+
+def has_revisions(config: Config) -> bool:
+    return ScriptDirectory.from_config(config).get_current_head() is not None
+
+
+def migrate(auth: Any, url: str, directory: str = None) -> list:
+    config = make_config(auth, url, directory)
+    # every revision, the initial one included, comes from `makemigrations` and
+    # is committed with the project. deploys only upgrade, so nodes deploying
+    # at once can't fork the history
+    if not has_revisions(config):
+        raise ArgumentsError(f'No revisions in {config.get_main_option("version_locations")},'
+                             f' run makemigrations once and commit them')
+    upgrade(config)
+    return sync_rights(auth, url)
+
+
+def sync_rights(auth: Any, url: str) -> list:
+    # the same reconciliation as on startup, returns the inserted rights. it runs
+    # on `url`, the database just migrated, not on auth's session_maker which
+    # may point elsewhere (e.g. the migration uses a privileged role or host)
+    engine = create_engine(url, poolclass=pool.NullPool)
+    if engine.dialect.is_async != auth._async_db:
+        raise ArgumentsError(f'{url.split(":", 1)[0]} is not a'
+                             f' {"async" if auth._async_db else "sync"} driver like AuthApp uses')
+    if not auth._async_db:
+        try:
+            with Session(engine) as db:
+                return auth.reconcile_rights(db)
+        finally:
+            engine.dispose()
+
+    async def run():
+        async_engine = AsyncEngine(engine)
+        try:
+            async with AsyncSession(async_engine) as db:
+                return await auth.reconcile_rights(db)
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+from typing import Any
+
+# token bucket: `burst` requests at once, refilled at `rate` per second.
+# hit() returns 0 when the request may pass, else seconds until it may.
+
+
+class BaseRateLimiter:
+    def __init__(self, rate: float = 1, burst: int = 10):
+        self.rate = rate
+        self.burst = burst
+
+    async def hit(self, key: str) -> float:
+        raise NotImplementedError
+
+
+class MemoryRateLimiter(BaseRateLimiter):
+    # single node only. hit() never awaits, so buckets are updated without locks
+    # on the event loop; each shard is kept in update order, idle buckets are
+    # found at its front without sorting
+    def __init__(self, rate: float = 1, burst: int = 10, shards: int = 64,
+                 max_keys: int = 100000):
+        super().__init__(rate, burst)
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._shard_size = max(max_keys // shards, 1)
+
+    def _evict(self, shard: OrderedDict, now: float) -> float:
+        # a bucket refilled to burst is the same as no bucket. returns 0 once
+        # there is room, else seconds until the oldest bucket has refilled
+        full = self.burst / self.rate
+        while shard:
+            _, updated = next(iter(shard.values()))
+            if now - updated < full:
+                break
+            shard.popitem(last=False)
+        if len(shard) < self._shard_size:
+            return 0
+        return full - (now - updated)
+
+    async def hit(self, key: str) -> float:
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        bucket = shard.get(key)
+        if bucket is None:
+            # keys are chosen by clients, forgetting a draining bucket to make
+            # room would reset its throttle, so the new key waits instead
+            if len(shard) >= self._shard_size:
+                retry = self._evict(shard, now)
+                if retry:
+                    return retry
+            bucket = (self.burst, now)
+        tokens, updated = bucket
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        retry = 0
+        if tokens < 1:
+            retry = (1 - tokens) / self.rate
+        else:
+            tokens -= 1
+        shard[key] = (tokens, now)
+        shard.move_to_end(key)
+        return retry
+
+
+class RedisRateLimiter(BaseRateLimiter):
+    # the bucket is read and written by one script, so all workers and nodes
+    # share it atomically; the redis clock is used to avoid worker clock skew
+    script = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local retry = 0
+if tokens < 1 then
+    retry = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(retry)
+"""
+
+    def __init__(self, redis: Any, rate: float = 1, burst: int = 10,
+                 prefix: str = 'fastapi_auth:rate:'):
+        super().__init__(rate, burst)
+        self._redis = redis
+        self._prefix = prefix
+        # EVALSHA, the script body is sent again only after a SCRIPT FLUSH
+        self._script = redis.register_script(self.script)
+
+    async def hit(self, key: str) -> float:
+        retry = await self._script(keys=[self._prefix + key], args=[self.burst, self.rate])
+        return float(retry)
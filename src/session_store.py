@@ -0,0 +1,120 @@
+import json
+import time
+from typing import Any, Dict, Iterable, Tuple
+
+
+class BaseSessionStore:
+
+    async def get(self, key: str, touch_ttl: int = None) -> Any:
+        raise NotImplementedError
+
+    async def get_many(self, keys: Iterable[str]) -> list:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: int = None) -> None:
+        raise NotImplementedError
+
+    async def set_many(self, items: Dict[str, Tuple[Any, int | None]]) -> None:
+        raise NotImplementedError
+
+    async def add(self, key: str, value: Any, ttl: int = None) -> bool:
+        raise NotImplementedError
+
+    async def expire(self, key: str, ttl: int) -> None:
+        raise NotImplementedError
+
+    async def delete(self, *keys: str) -> None:
+        raise NotImplementedError
+
+
+class RedisSessionStore(BaseSessionStore):
+    def __init__(self, redis: Any, prefix: str = 'fastapi_auth:session:'):
+        self._redis = redis
+        self._prefix = prefix
+
+    async def get(self, key: str, touch_ttl: int = None) -> Any:
+        if touch_ttl is None:
+            value = await self._redis.get(self._prefix + key)
+        else:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.get(self._prefix + key)
+                pipe.expire(self._prefix + key, touch_ttl)
+                value, _ = await pipe.execute()
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def get_many(self, keys: Iterable[str]) -> list:
+        values = await self._redis.mget([self._prefix + k for k in keys])
+        return [None if v is None else json.loads(v) for v in values]
+
+    async def set(self, key: str, value: Any, ttl: int = None) -> None:
+        await self._redis.set(self._prefix + key, json.dumps(value, default=str), ex=ttl)
+
+    async def set_many(self, items: Dict[str, Tuple[Any, int | None]]) -> None:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, (value, ttl) in items.items():
+                pipe.set(self._prefix + key, json.dumps(value, default=str), ex=ttl)
+            await pipe.execute()
+
+    async def add(self, key: str, value: Any, ttl: int = None) -> bool:
+        return bool(await self._redis.set(self._prefix + key, json.dumps(value, default=str),
+                                          ex=ttl, nx=True))
+
+    async def expire(self, key: str, ttl: int) -> None:
+        await self._redis.expire(self._prefix + key, ttl)
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self._redis.delete(*[self._prefix + k for k in keys])
+
+
+class MemorySessionStore(BaseSessionStore):
+    def __init__(self):
+        self._data = {}
+        self._next_sweep = 1024
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        self._data = {k: v for k, v in self._data.items() if v[1] is None or v[1] > now}
+        self._next_sweep = max(1024, len(self._data) * 2)
+
+    def _get(self, key: str) -> Any:
+        value, expires_at = self._data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def get(self, key: str, touch_ttl: int = None) -> Any:
+        value = self._get(key)
+        if value is not None and touch_ttl is not None:
+            self._data[key] = (value, time.monotonic() + touch_ttl)
+        return value
+
+    async def get_many(self, keys: Iterable[str]) -> list:
+        return [self._get(k) for k in keys]
+
+    async def set(self, key: str, value: Any, ttl: int = None) -> None:
+        if len(self._data) >= self._next_sweep:
+            self._sweep()
+        self._data[key] = (value, None if ttl is None else time.monotonic() + ttl)
+
+    async def set_many(self, items: Dict[str, Tuple[Any, int | None]]) -> None:
+        for key, (value, ttl) in items.items():
+            await self.set(key, value, ttl)
+
+    async def add(self, key: str, value: Any, ttl: int = None) -> bool:
+        if self._get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def expire(self, key: str, ttl: int) -> None:
+        value = self._get(key)
+        if value is not None:
+            self._data[key] = (value, time.monotonic() + ttl)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
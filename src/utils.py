@@ -1,3 +1,4 @@
+import base64
 import hashlib
 from functools import wraps
 from typing import Callable, Any
@@ -35,6 +36,15 @@ def hash_validator_maker(field_name: str, hash_func: Callable[[str], str]):
     return field_validator(field_name)(hash_func)
 
 
+def encode_perms_mask(mask: int) -> str:
+    raw = mask.to_bytes(max((mask.bit_length() + 7) // 8, 1), 'little')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_perms_mask(value: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(value), 'little')
+
+
 def get_current_user():
     pass
 
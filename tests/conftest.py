@@ -0,0 +1,15 @@
+import importlib.util
+import os
+import sys
+
+# the repository root is the fastapi_auth package, make it importable under
+# that name when the checkout directory is called something else
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'fastapi_auth' not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        'fastapi_auth', os.path.join(ROOT, '__init__.py'),
+        submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['fastapi_auth'] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from fastapi_auth.src.batching import BatchLoader
+
+
+class Recorder:
+    def __init__(self, delay: float = 0):
+        self.calls = []
+        self.delay = delay
+
+    async def __call__(self, keys):
+        self.calls.append(keys)
+        await asyncio.sleep(self.delay)
+        return {k: k * 10 for k in keys}
+
+
+def test_loads_in_one_tick_share_a_batch():
+    batch = Recorder()
+
+    async def main():
+        loader = BatchLoader(batch)
+        return await asyncio.gather(loader.load(1), loader.load(2), loader.load(1))
+
+    assert asyncio.run(main()) == [10, 20, 10]
+    assert batch.calls == [[1, 2]]
+
+
+def test_in_flight_key_is_not_loaded_again():
+    batch = Recorder(delay=0.01)
+
+    async def main():
+        loader = BatchLoader(batch)
+        first = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        second = await loader.load(1)
+        return await first, second
+
+    assert asyncio.run(main()) == (10, 10)
+    assert batch.calls == [[1]]
+
+
+def test_next_tick_starts_a_new_batch():
+    batch = Recorder()
+
+    async def main():
+        loader = BatchLoader(batch)
+        await loader.load(1)
+        await loader.load(1)
+
+    asyncio.run(main())
+    assert batch.calls == [[1], [1]]
+
+
+def test_missing_key_resolves_to_none():
+    async def batch(keys):
+        return {}
+
+    async def main():
+        return await BatchLoader(batch).load(1)
+
+    assert asyncio.run(main()) is None
+
+
+def test_batch_error_reaches_every_caller():
+    async def batch(keys):
+        raise ValueError('db down')
+
+    async def main():
+        loader = BatchLoader(batch)
+        return await asyncio.gather(loader.load(1), loader.load(2), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    batch = Recorder(delay=0.01)
+
+    async def main():
+        loader = BatchLoader(batch)
+        cancelled = asyncio.ensure_future(loader.load(1))
+        other = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        # the key is still in flight and can be joined
+        late = await loader.load(1)
+        return await other, late
+
+    assert asyncio.run(main()) == (10, 10)
+    assert batch.calls == [[1]]
+
+
+def test_cancelled_batch_func_cancels_waiters():
+    async def main():
+        event = asyncio.Event()
+
+        async def batch(keys):
+            event.set()
+            await asyncio.sleep(10)
+
+        loader = BatchLoader(batch)
+        waiter = asyncio.ensure_future(loader.load(1))
+        await event.wait()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task() and task is not waiter:
+                task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not loader._in_flight
+
+    asyncio.run(main())
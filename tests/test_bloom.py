@@ -0,0 +1,32 @@
+from fastapi_auth.src.bloom import BloomFilter
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(1000)
+    items = [f'user{i}' for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    assert bloom.count == 1000
+
+
+def test_false_positive_rate_near_target():
+    bloom = BloomFilter(10000, fp_rate=0.01)
+    for i in range(10000):
+        bloom.add(f'user{i}')
+    hits = sum(f'other{i}' in bloom for i in range(10000))
+    assert hits < 300
+
+
+def test_empty_filter_contains_nothing():
+    bloom = BloomFilter(0)
+    assert bloom.capacity == 1
+    assert 'anyone' not in bloom
+
+
+def test_max_bytes_caps_the_bit_array():
+    bloom = BloomFilter(1000000, max_bytes=1024)
+    assert bloom.nbytes == 1024
+    assert bloom.hashes >= 1
+    bloom.add('user')
+    assert 'user' in bloom
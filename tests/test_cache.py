@@ -0,0 +1,55 @@
+import time
+
+from fastapi_auth.src.cache import TTLCache
+
+
+def test_get_and_counters():
+    cache = TTLCache()
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entry_is_dropped():
+    cache = TTLCache()
+    cache.set('a', 1, expires_at=time.time() - 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_expires_at_is_capped_by_ttl(monkeypatch):
+    cache = TTLCache(ttl=10)
+    now = time.time()
+    cache.set('a', 1, expires_at=now + 3600)
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get('a') is None
+
+
+def test_earlier_expires_at_wins(monkeypatch):
+    cache = TTLCache(ttl=60)
+    now = time.time()
+    cache.set('a', 1, expires_at=now + 5)
+    monkeypatch.setattr(time, 'time', lambda: now + 6)
+    assert cache.get('a') is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+
+def test_pop_and_clear():
+    cache = TTLCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.pop('a')
+    cache.pop('missing')
+    assert cache.get('a') is None
+    cache.clear()
+    assert len(cache) == 0
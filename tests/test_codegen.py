@@ -0,0 +1,42 @@
+import pytest
+
+for module in ('pydantic', 'sqlalchemy'):
+    pytest.importorskip(module)
+
+from pydantic import BaseModel
+
+from fastapi_auth.src import codegen
+from fastapi_auth.src.fields import IdentityField, LoginField, Permission, RegisterField
+from fastapi_auth.src.hashers import ScryptHasher
+
+hasher = ScryptHasher()
+
+
+class Roles(BaseModel):
+    client: object = Permission(read=True)
+
+
+class User(BaseModel):
+    id: int = IdentityField()
+    password: str = (RegisterField(hash_func=hasher), LoginField(hash_func=hasher))
+    username: str = (RegisterField(), LoginField())
+
+
+def test_fingerprint_is_stable():
+    assert codegen.fingerprint(User, Roles, a=1) == codegen.fingerprint(User, Roles, a=1)
+    assert codegen.fingerprint(User, Roles, a=1) != codegen.fingerprint(User, Roles, a=2)
+
+
+def test_fingerprint_covers_hasher_params(monkeypatch):
+    before = codegen.fingerprint(User, Roles)
+    monkeypatch.setattr(hasher, 'n', 2 ** 15)
+    assert codegen.fingerprint(User, Roles) != before
+
+
+def test_fingerprint_ignores_hasher_caches():
+    before = codegen.fingerprint(User, Roles)
+    hasher._dummy = 'cached'
+    try:
+        assert codegen.fingerprint(User, Roles) == before
+    finally:
+        hasher._dummy = None
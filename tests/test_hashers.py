@@ -0,0 +1,20 @@
+from fastapi_auth.src.hashers import ScryptHasher, PBKDF2Hasher
+
+
+def test_verify_and_rehash():
+    hasher = ScryptHasher(n=2 ** 4)
+    encoded = hasher.hash('password')
+    assert hasher.verify('password', encoded)
+    assert not hasher.verify('wrong', encoded)
+    assert not hasher.needs_rehash(encoded)
+    assert ScryptHasher(n=2 ** 5).needs_rehash(encoded)
+    assert PBKDF2Hasher(iterations=1000).verify('password', encoded)
+
+
+def test_dummy_verify_uses_the_hasher_params():
+    hasher = ScryptHasher(n=2 ** 4)
+    assert hasher.dummy_verify('password') is False
+    dummy = hasher._dummy
+    assert not hasher.needs_rehash(dummy)
+    hasher.dummy_verify('other')
+    assert hasher._dummy is dummy
@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('jwt')
+
+from fastapi_auth.src import keys
+from fastapi_auth.src.exceptions import ArgumentsError
+from fastapi_auth.src.keys import KeyRing
+
+T0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+HOUR = datetime.timedelta(hours=1)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [T0]
+    monkeypatch.setattr(keys, '_now', lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=['RS256', 'EdDSA'])
+def ring(request):
+    return KeyRing(algorithm=request.param, overlap=HOUR)
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ArgumentsError):
+        KeyRing(algorithm='HS256')
+
+
+def test_empty_ring_has_no_signing_key(ring, clock):
+    with pytest.raises(ArgumentsError):
+        ring.signing_key()
+
+
+def test_kid_is_derived_from_the_public_key(ring):
+    private_key = ring.generate_key()
+    other = KeyRing(algorithm=ring.algorithm)
+    assert ring.add_key(private_key) == other.add_key(private_key)
+    assert ring.add_key(ring.generate_key()) != ring.add_key(private_key)
+
+
+def test_pem_keys_are_loaded(ring):
+    from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, NoEncryption
+    private_key = ring.generate_key()
+    pem = private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+    assert ring.add_key(pem.decode('ascii')) == KeyRing(ring.algorithm).add_key(private_key)
+
+
+def test_rotation(ring, clock):
+    old = ring.add_key(ring.generate_key())
+    new = ring.add_key(ring.generate_key(), not_before=T0 + HOUR)
+
+    # the upcoming key is published but doesn't sign or verify yet
+    assert ring.signing_key()[0] == old
+    assert ring.verification_key(new) is None
+    assert {k['kid'] for k in ring.jwks()['keys']} == {old, new}
+
+    # the new key signs, the old one still verifies during the overlap
+    clock[0] = T0 + HOUR
+    assert ring.signing_key()[0] == new
+    assert ring.verification_key(old) is not None
+    assert ring.verification_key(new) is not None
+
+    # after the overlap the old key is retired
+    clock[0] = T0 + 2 * HOUR + datetime.timedelta(seconds=1)
+    assert ring.verification_key(old) is None
+    assert [k['kid'] for k in ring.jwks()['keys']] == [new]
+
+
+def test_unknown_kid(ring, clock):
+    ring.add_key(ring.generate_key())
+    assert ring.verification_key('nope') is None
+    assert ring.verification_key(None) is None
+
+
+def test_jwks_entries(ring, clock):
+    kid = ring.add_key(ring.generate_key())
+    jwks = ring.jwks()
+    assert jwks is ring.jwks()
+    (jwk,) = jwks['keys']
+    assert (jwk['kid'], jwk['alg'], jwk['use']) == (kid, ring.algorithm, 'sig')
+    assert 'd' not in jwk
+
+
+def test_signed_token_verifies(ring, clock):
+    import jwt
+    ring.add_key(ring.generate_key())
+    kid, private_key = ring.signing_key()
+    token = jwt.encode({'uid': 1}, private_key, algorithm=ring.algorithm, headers={'kid': kid})
+    key = ring.verification_key(jwt.get_unverified_header(token)['kid'])
+    assert jwt.decode(token, key, algorithms=[ring.algorithm]) == {'uid': 1}
+
+
+def test_without_overlap_rotated_keys_stay(clock):
+    ring = KeyRing()
+    assert ring.overlap is None
+    old = ring.add_key(ring.generate_key())
+    ring.add_key(ring.generate_key(), not_before=T0 + HOUR)
+    clock[0] = T0 + 1000 * HOUR
+    assert ring.verification_key(old) is not None
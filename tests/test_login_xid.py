@@ -0,0 +1,27 @@
+import pytest
+
+for module in ('pydantic', 'sqlalchemy'):
+    pytest.importorskip(module)
+
+from sqlalchemy import BigInteger, Column, MetaData, Table
+
+from fastapi_auth.src.class_builder import attach_login_xid_trigger, login_xid_trigger
+
+
+def test_trigger_statements_quote_reserved_names():
+    create, drop = login_xid_trigger('user')
+    assert 'NEW.login_xid := pg_current_xact_id()::text::bigint' in create[0]
+    assert create[1].startswith('CREATE TRIGGER login_xid BEFORE UPDATE ON "user"')
+    assert drop == ['DROP FUNCTION IF EXISTS "user_login_xid"() CASCADE']
+
+
+def test_trigger_statements_with_schema():
+    create, drop = login_xid_trigger('user', 'auth')
+    assert ' ON "auth"."user" ' in create[1]
+    assert drop == ['DROP FUNCTION IF EXISTS "auth"."user_login_xid"() CASCADE']
+
+
+def test_attach_marks_the_table():
+    table = Table('user', MetaData(), Column('login_xid', BigInteger))
+    attach_login_xid_trigger(table)
+    assert table.info['login_xid_trigger'] is True
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import pytest
+
+from fastapi_auth.src.rate_limit import MemoryRateLimiter, RedisRateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+def hits(limiter, key, n):
+    async def main():
+        return [await limiter.hit(key) for _ in range(n)]
+    return asyncio.run(main())
+
+
+def test_burst_then_retry_after(clock):
+    limiter = MemoryRateLimiter(rate=2, burst=3)
+    assert hits(limiter, 'ip', 3) == [0, 0, 0]
+    assert hits(limiter, 'ip', 1) == [pytest.approx(0.5)]
+
+
+def test_bucket_refills_at_rate(clock):
+    limiter = MemoryRateLimiter(rate=2, burst=3)
+    hits(limiter, 'ip', 3)
+    clock.now += 0.5
+    assert hits(limiter, 'ip', 2) == [0, pytest.approx(0.5)]
+
+
+def test_keys_are_independent(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=1)
+    assert hits(limiter, 'a', 1) == [0]
+    assert hits(limiter, 'b', 1) == [0]
+    assert hits(limiter, 'a', 1) != [0]
+
+
+def test_full_buckets_are_evicted(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=2, shards=1, max_keys=2)
+    hits(limiter, 'a', 1)
+    hits(limiter, 'b', 1)
+    clock.now += 2
+    hits(limiter, 'c', 1)
+    assert set(limiter._shards[0]) == {'c'}
+
+
+def test_draining_buckets_are_kept_over_max_keys(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=2, shards=1, max_keys=2)
+    hits(limiter, 'victim', 2)
+    clock.now += 0.5
+    hits(limiter, 'junk', 1)
+    # no room, the new key waits until the oldest bucket has refilled
+    assert hits(limiter, 'other', 1) == [pytest.approx(1.5)]
+    assert set(limiter._shards[0]) == {'victim', 'junk'}
+    assert hits(limiter, 'victim', 1) == [pytest.approx(0.5)]
+
+
+def test_recently_hit_buckets_are_evicted_last(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=1, shards=1, max_keys=2)
+    hits(limiter, 'a', 1)
+    clock.now += 0.5
+    hits(limiter, 'b', 1)
+    clock.now += 0.6
+    hits(limiter, 'a', 1)
+    clock.now += 0.5
+    hits(limiter, 'c', 1)
+    assert list(limiter._shards[0]) == ['a', 'c']
+
+
+def test_redis_limiter_shares_the_bucket():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+
+    async def main():
+        redis = fakeredis.FakeAsyncRedis()
+        first = RedisRateLimiter(redis, rate=1, burst=2)
+        second = RedisRateLimiter(redis, rate=1, burst=2)
+        return [await first.hit('ip'), await second.hit('ip'), await first.hit('ip')]
+
+    passed, shared, limited = asyncio.run(main())
+    assert passed == shared == 0
+    assert 0 < limited <= 1
@@ -0,0 +1,68 @@
+import asyncio
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+
+for module in ('fastapi', 'jwt', 'pydantic', 'sqlalchemy'):
+    pytest.importorskip(module)
+
+import jwt
+
+from fastapi_auth.src.cache import TTLCache
+from fastapi_auth.src.method_builders import AsyncMethodBuilder
+
+SECRET = 'secret'
+
+
+@pytest.fixture
+def auth():
+    resolve_access = AsyncMethodBuilder(use_session=False, use_jwt=True).build_resolve_access()
+    auth = SimpleNamespace(
+        access_cache=TTLCache(),
+        decode_token=lambda token: jwt.decode(token, key=SECRET, algorithms=['HS256']),
+    )
+    auth.resolve_access = resolve_access.__get__(auth)
+    return auth
+
+
+def token(key=SECRET, lifetime=datetime.timedelta(minutes=5), **claims):
+    exp = datetime.datetime.now(tz=datetime.timezone.utc) + lifetime
+    return jwt.encode({'uid': 1, 'exp': exp, **claims}, key, algorithm='HS256')
+
+
+def resolve(auth, access):
+    return asyncio.run(auth.resolve_access(access))
+
+
+def msg(response):
+    return response.status_code, json.loads(response.body)['msg']
+
+
+def test_valid_token_is_cached(auth):
+    access = token()
+    payload = resolve(auth, access)
+    assert payload['uid'] == 1
+    assert resolve(auth, access) is payload
+    assert auth.access_cache.hits == 1
+
+
+def test_expired_token(auth):
+    access = token(lifetime=-datetime.timedelta(minutes=1))
+    assert msg(resolve(auth, access)) == (403, 'access token expired')
+
+
+def test_refresh_token_is_rejected(auth):
+    assert msg(resolve(auth, token(typ='refresh'))) == (403, 'Invalid access token')
+    assert len(auth.access_cache) == 0
+
+
+@pytest.mark.parametrize('access', [
+    token(key='other'),
+    'not.a.token',
+    'garbage',
+    jwt.encode({'uid': 1}, SECRET, algorithm='HS512'),
+])
+def test_invalid_tokens(auth, access):
+    assert msg(resolve(auth, access)) == (403, 'Invalid access token')
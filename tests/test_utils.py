@@ -0,0 +1,17 @@
+import pytest
+
+pytest.importorskip('pydantic')
+
+from fastapi_auth.src.utils import encode_perms_mask, decode_perms_mask
+
+
+@pytest.mark.parametrize('mask', [0, 1, 0b1010, 2 ** 62, 2 ** 63 - 1, 2 ** 200 + 5])
+def test_perms_mask_round_trip(mask):
+    assert decode_perms_mask(encode_perms_mask(mask)) == mask
+
+
+def test_perms_mask_is_url_safe_and_short():
+    value = encode_perms_mask(2 ** 63 - 1)
+    assert set(value) <= set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=')
+    assert len(value) == 12
+    assert encode_perms_mask(0) == 'AA=='